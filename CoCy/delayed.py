@@ -0,0 +1,93 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from threading import Lock
+from circuits.core.components import BaseComponent
+from circuits.core.events import Event
+from circuits.core.handlers import handler
+from .misc import monotonic
+
+class _wakeup(Event):
+    pass
+
+class DelayedActions(BaseComponent):
+    """
+    Fires events after a delay. Every action has a name, scheduling
+    an action that is already pending moves its deadline (i.e. the
+    timer is reset) instead of adding another timer. A single
+    instance serves all delayed actions of its parent, so no
+    components are created or left behind per action.
+
+    Events are fired on the component's channel. Actions may be
+    scheduled and cancelled from any thread.
+    """
+
+    def __init__(self, channel=None):
+        super(DelayedActions, self).__init__(channel=channel)
+        self._lock = Lock()
+        # name -> (expiry, event)
+        self._actions = dict()
+
+    def schedule(self, name, delay, event):
+        """
+        Fire *event* after *delay* seconds, replacing the pending
+        action *name* (if any).
+        """
+        expiry = monotonic() + delay
+        with self._lock:
+            earliest = self._next_expiry()
+            self._actions[name] = (expiry, event)
+        if earliest is None or expiry < earliest:
+            # Let the event loop recalculate how long it may wait
+            self.fire(_wakeup())
+
+    def cancel(self, name):
+        """
+        Drop the pending action *name*.
+        """
+        with self._lock:
+            self._actions.pop(name, None)
+
+    def pending(self, name):
+        return name in self._actions
+
+    def __len__(self):
+        return len(self._actions)
+
+    def _next_expiry(self):
+        if not self._actions:
+            return None
+        return min(expiry for expiry, _ in self._actions.values())
+
+    @handler("generate_events")
+    def _on_generate_events(self, event):
+        now = monotonic()
+        with self._lock:
+            expired = [(name, action) for name, action
+                       in self._actions.items() if action[0] <= now]
+            for name, _ in expired:
+                del self._actions[name]
+            next_at = self._next_expiry()
+        for _, (_, action_event) in sorted(expired, key=lambda a: a[1][0]):
+            self.fire(action_event)
+        if expired:
+            event.reduce_time_left(0)
+        elif next_at is not None:
+            event.reduce_time_left(next_at - now)
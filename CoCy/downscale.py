@@ -0,0 +1,189 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from collections import OrderedDict
+from twisted.internet import defer
+from .metrics import metrics
+from .misc import monotonic, remove_files
+import os
+import signal
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+def available():
+    """
+    Downscaling requires the python imaging library.
+    """
+    return Image is not None
+
+class DownscaleError(Exception):
+    pass
+
+def _init_worker():
+    # Workers are forked from the main process and inherit the
+    # reactor's signal handlers, they wouldn't terminate otherwise.
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+
+def _downscale(source, target, width, height, quality):
+    # Runs in a worker process. Pool.apply_async has no error
+    # callback in python 2, so errors are returned as message.
+    try:
+        image = Image.open(source)
+        if image.size[0] <= width and image.size[1] <= height:
+            return (None, None)
+        if image.format == "JPEG":
+            # Let the JPEG decoder reduce the size (by 1/2, 1/4 or 1/8)
+            # while decoding, this is much faster than a full decode.
+            image.draft("RGB", (width, height))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.thumbnail((width, height), Image.ANTIALIAS)
+        part = target + ".part"
+        image.save(part, "JPEG", quality=quality)
+        os.rename(part, target)
+        return (target, None)
+    except Exception as e:
+        return (None, "%s: %s" % (type(e).__name__, e))
+
+
+class Downscaler(object):
+    """
+    Downscales pictures that are larger than *width* x *height* using
+    a pool of *processes* worker processes. The scaled pictures are
+    kept in *directory* (at most *max_files* of them), files left
+    there by a previous run are removed. At most
+    *max_queued* requests wait for a worker, older requests are
+    cancelled if more arrive.
+
+    Must only be used from the main thread.
+    """
+
+    def __init__(self, width, height, processes=1, max_queued=2,
+                 directory="/tmp/picviewer/scaled", max_files=16,
+                 quality=85, reactor=None, pool_factory=None):
+        self.width = width
+        self.height = height
+        self.processes = processes
+        self.max_queued = max_queued
+        self._directory = directory
+        self.max_files = max_files
+        self.quality = quality
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._pool_factory = pool_factory
+        self._pool = None
+        self._queue = []
+        self._running = 0
+        self._files = OrderedDict()
+        # Files from previous runs are unknown to the index and
+        # would never be evicted
+        remove_files(self._directory)
+
+    def _target(self, path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self._directory, name + ".jpg")
+
+    def scale(self, path):
+        """
+        Returns a deferred that fires with the name of the file to be
+        displayed instead of *path* (which is *path* itself if the
+        picture isn't too large). Cancelling the deferred drops the
+        request if it hasn't been started yet.
+        """
+        target = self._target(path)
+        if target in self._files and os.path.exists(target) \
+                and os.path.getmtime(target) >= os.path.getmtime(path):
+            self._files[target] = self._files.pop(target)
+            return defer.succeed(target)
+        d = defer.Deferred(canceller=self._cancel)
+        self._queue.append((d, path, target, monotonic()))
+        while len(self._queue) > self.max_queued:
+            self._queue[0][0].cancel()
+        self._next()
+        return d
+
+    def _cancel(self, d):
+        self._queue = [job for job in self._queue if job[0] is not d]
+        metrics.count("picture.downscale_cancelled")
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self._pool_factory is None:
+                import multiprocessing
+                self._pool = multiprocessing.Pool(self.processes,
+                                                  _init_worker)
+            else:
+                self._pool = self._pool_factory(self.processes)
+            self._reactor.addSystemEventTrigger("before", "shutdown",
+                                                self.close)
+        return self._pool
+
+    def _next(self):
+        while self._running < self.processes and self._queue:
+            job = self._queue.pop(0)
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            self._running += 1
+            def _callback(result, job=job):
+                # Invoked by the pool's result handler thread
+                self._reactor.callFromThread(self._done, job, result)
+            self._get_pool().apply_async(
+                _downscale, (job[1], job[2], self.width, self.height,
+                             self.quality), callback=_callback)
+
+    def _done(self, job, result):
+        self._running -= 1
+        d, path, target, queued = job
+        scaled, error = result
+        metrics.observe("picture.downscale", monotonic() - queued)
+        if scaled is not None:
+            metrics.count("picture.downscaled")
+            self._add(scaled)
+        if not d.called:
+            if error is not None:
+                d.errback(DownscaleError(error))
+            else:
+                d.callback(scaled or path)
+        self._next()
+
+    def _add(self, target):
+        self._files.pop(target, None)
+        self._files[target] = None
+        while len(self._files) > self.max_files:
+            oldest = next(iter(self._files))
+            del self._files[oldest]
+            if os.path.exists(oldest):
+                os.remove(oldest)
+
+    def close(self):
+        """
+        Terminate the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
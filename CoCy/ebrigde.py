@@ -2,12 +2,12 @@
 ..
    This file is part of the CoCy program.
    Copyright (C) 2018 Michael N. Lipp
-   
+
    This program is free software: you can redistribute it and/or modify
    it under the terms of the GNU General Public License as published by
    the Free Software Foundation, either version 3 of the License, or
    (at your option) any later version.
-   
+
    This program is distributed in the hope that it will be useful,
    but WITHOUT ANY WARRANTY; without even the implied warranty of
    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
@@ -18,56 +18,307 @@
 
 """
 
-# Taken from https://pastebin.com/dqHGnJ8B
-from threading import currentThread
-from twisted.internet import reactor, defer
+# Originally taken from https://pastebin.com/dqHGnJ8B
+from threading import currentThread, Condition
+from twisted.internet import defer
 from twisted.python import failure
-import Queue
+from .misc import monotonic
+
+DEFAULT_TIMEOUT = 30
+"""Seconds to wait for the main thread before giving up."""
+
+class BridgeTimeout(ValueError):
+    """
+      Raised if the main thread doesn't deliver a result in time.
+      Derived from ``ValueError`` because this is what callers
+      of :func:`blockingCallOnMainThread` have always been prepared for.
+    """
+    pass
+
+class MainThreadFuture(object):
+    """
+      The (future) result of a call submitted to the main thread.
+      Results are delivered by the main thread, any other thread
+      may wait for them.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._done = False
+        self._result = None
+        self._failure = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_failure(self, fail):
+        self._complete(None, fail)
+
+    def _resolve(self, result):
+        # Usable as callback and errback of a deferred
+        if isinstance(result, failure.Failure):
+            self.set_failure(result)
+        else:
+            self.set_result(result)
+
+    def _complete(self, result, fail):
+        with self._cond:
+            if self._done:
+                return
+            self._result = result
+            self._failure = fail
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._cond.notifyAll()
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+          Invoke *callback* with this future as argument once the result
+          is available. The callback is invoked by the thread that
+          delivers the result or immediately if the result is already
+          available.
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=DEFAULT_TIMEOUT):
+        """
+          Wait at most *timeout* seconds (forever if ``None``) for
+          the result. Raises :class:`BridgeTimeout` if the result isn't
+          available in time, or the exception raised by the call.
+        """
+        with self._cond:
+            if not self._done:
+                if timeout is None:
+                    while not self._done:
+                        self._cond.wait()
+                else:
+                    deadline = monotonic() + timeout
+                    while not self._done:
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+            if not self._done:
+                raise BridgeTimeout("Reactor no longer active, aborting.")
+        if self._failure is not None:
+            self._failure.raiseException()
+        return self._result
+
+
+class MainThreadBridge(object):
+    """
+      Executes calls on the thread that runs the twisted reactor (i.e.
+      the Enigma2 main loop). The reactor and the test for being on the
+      main thread may be replaced, which allows the bridge to be used
+      without a running Enigma2. If *metrics* (a
+      :class:`~.metrics.Metrics`) is given, the time that calls wait
+      for the main thread and their execution time are recorded.
+
+      If a *watchdog* (a :class:`~.watchdog.MainLoopWatchdog`) is set,
+      blocking calls wait as long as the main loop shows signs of life
+      (instead of :attr:`timeout` seconds) and are abandoned
+      immediately when the reactor shuts down. A call whose result
+      never arrives (e.g. a deferred that never fires) is abandoned
+      after :attr:`timeout` seconds or the watchdog's timeout,
+      whichever is longer, even if the main loop is healthy.
+    """
+
+    def __init__(self, reactor=None, is_main_thread=None,
+                 timeout=DEFAULT_TIMEOUT, metrics=None, watchdog=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        if is_main_thread is not None:
+            self.isMainThread = is_main_thread
+        self.timeout = timeout
+        self.metrics = metrics
+        self.watchdog = watchdog
+
+    @property
+    def reactor(self):
+        return self._reactor
+
+    def isMainThread(self):
+        return currentThread().getName() == 'MainThread'
+
+    def _run(self, future, func, args, kwargs, queued=None):
+        if self.metrics is None:
+            result = defer.maybeDeferred(func, *args, **kwargs)
+            result.addBoth(future._resolve)
+            return
+        started = monotonic()
+        if queued is not None:
+            self.metrics.observe("bridge.queue_delay", started - queued)
+        result = defer.maybeDeferred(func, *args, **kwargs)
+        self.metrics.observe("bridge.execution", monotonic() - started)
+        result.addBoth(future._resolve)
+
+    def _runBatch(self, batch, queued=None):
+        if self.metrics is not None and queued is not None:
+            self.metrics.observe("bridge.queue_delay", monotonic() - queued)
+        for future, func, args, kwargs in batch:
+            self._run(future, func, args, kwargs)
+
+    def _queued(self):
+        return None if self.metrics is None else monotonic()
+
+    def submit(self, func, *args, **kwargs):
+        """
+          Call *func* on the main thread and return a
+          :class:`MainThreadFuture` for the result. If invoked on
+          the main thread, *func* is called immediately.
+        """
+        future = MainThreadFuture()
+        if self.isMainThread():
+            self._run(future, func, args, kwargs)
+        else:
+            self._reactor.callFromThread(self._run, future, func, args, kwargs,
+                                         self._queued())
+        return future
+
+    def submitBatch(self, calls):
+        """
+          Call several functions on the main thread using a single
+          hop. *calls* is a sequence of callables or of tuples
+          ``(func, args, kwargs)``. The functions are invoked in order,
+          a failing function does not prevent the others from being
+          called. Returns the list of futures for the results.
+        """
+        batch = []
+        for call in calls:
+            if callable(call):
+                call = (call,)
+            func = call[0]
+            args = call[1] if len(call) > 1 else ()
+            kwargs = call[2] if len(call) > 2 else {}
+            batch.append((MainThreadFuture(), func, args, kwargs))
+        if batch:
+            if self.isMainThread():
+                self._runBatch(batch)
+            else:
+                self._reactor.callFromThread(self._runBatch, batch,
+                                             self._queued())
+        return [entry[0] for entry in batch]
+
+    def blockingCall(self, func, *args, **kwargs):
+        """
+          Call *func* on the main thread and wait (at most
+          :attr:`timeout` seconds) for the result.
+        """
+        if self.isMainThread():
+            return func(*args, **kwargs)
+        future = self.submit(func, *args, **kwargs)
+        if self.watchdog is None:
+            return future.result(self.timeout)
+        return self._await(future)
+
+    def _await(self, future):
+        # Wait in slices, checking the main loop's state in between
+        watchdog = self.watchdog
+        bound = max(self.timeout, watchdog.timeout())
+        deadline = monotonic() + bound
+        while True:
+            if watchdog.shutting_down:
+                raise BridgeTimeout("Reactor shutting down, aborting.")
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                self._timed_out()
+                raise BridgeTimeout("No result within %.1f s, aborting."
+                                    % bound)
+            if not watchdog.running:
+                return future.result(remaining)
+            try:
+                return future.result(min(watchdog.interval, remaining))
+            except BridgeTimeout:
+                if future.done():
+                    raise
+            limit = watchdog.timeout()
+            if watchdog.stalled() > limit:
+                self._timed_out()
+                raise BridgeTimeout("Main loop stalled for more than"
+                                    " %.1f s, aborting." % limit)
+
+    def _timed_out(self):
+        if self.metrics is not None:
+            self.metrics.count("bridge.timeouts")
+
+    def call(self, func, *args, **kwargs):
+        """
+          Ensures that *func* is called on the main thread. No return
+          value here!
+        """
+        if self.isMainThread():
+            #call on next mainloop interation
+            self._reactor.callLater(0, func, *args, **kwargs)
+        else:
+            #call on mainthread
+            self._reactor.callFromThread(func, *args, **kwargs)
+
+
+_bridge = None
+
+def mainThreadBridge():
+    """
+      Returns the bridge used by the module level functions.
+    """
+    global _bridge
+    if _bridge is None:
+        from .metrics import metrics
+        _bridge = MainThreadBridge(metrics=metrics)
+    return _bridge
+
+def setMainThreadBridge(bridge):
+    """
+      Replaces the bridge used by the module level functions
+      (e.g. with one that uses a fake reactor).
+    """
+    global _bridge
+    _bridge = bridge
 
 def blockingCallOnMainThread(func, *args, **kwargs):
     """
       Modified version of twisted.internet.threads.blockingCallFromThread
-      which waits 30s for results and otherwise assumes the system to be shut down.
+      which waits 30s for results and otherwise assumes the system to be shut down
+      (unless a watchdog has been set for the bridge, see
+      :class:`MainThreadBridge`).
       This is an ugly workaround for a twisted-internal deadlock.
       Please keep the look intact in case someone comes up with a way
       to reliably detect from the outside if twisted is currently shutting
       down.
-    """
-    def blockingCallFromThread(f, *a, **kw):
-        queue = Queue.Queue()
-        def _callFromThread():
-            result = defer.maybeDeferred(f, *a, **kw)
-            result.addBoth(queue.put)
-        reactor.callFromThread(_callFromThread)
 
-        result = None
-        while True:
-            try:
-                result = queue.get(True, 30)
-            except Queue.Empty as qe:
-                if True: #not reactor.running: # reactor.running is only False AFTER shutdown, we are during.
-                    raise ValueError("Reactor no longer active, aborting.")
-            else:
-                break
+      Use :func:`submitOnMainThread` and
+      :meth:`MainThreadFuture.result` if a different timeout is required.
+    """
+    return mainThreadBridge().blockingCall(func, *args, **kwargs)
 
-        if isinstance(result, failure.Failure):
-            result.raiseException()
-        return result
+def submitOnMainThread(func, *args, **kwargs):
+    """
+      Non-blocking variant of :func:`blockingCallOnMainThread`, returns
+      a :class:`MainThreadFuture`.
+    """
+    return mainThreadBridge().submit(func, *args, **kwargs)
 
-    if currentThread().getName() == 'MainThread':
-        return func(*args, **kwargs)
-    else:
-        return blockingCallFromThread(func, *args, **kwargs)
+def submitBatchOnMainThread(calls):
+    """
+      Invokes all *calls* in a single main thread hop, see
+      :meth:`MainThreadBridge.submitBatch`.
+    """
+    return mainThreadBridge().submitBatch(calls)
 
 def callOnMainThread(func, *args, **kwargs):
     """
       Ensures that a method is being called on the main-thread.
       No return value here!
     """
-    if currentThread().getName() == 'MainThread':
-        #call on next mainloop interation
-        reactor.callLater(0, func, *args, **kwargs)
-    else:
-        #call on mainthread
-        reactor.callFromThread(func, *args, **kwargs)
-
+    mainThreadBridge().call(func, *args, **kwargs)
@@ -0,0 +1,185 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.python import failure
+from twisted.web.client import Agent, RedirectAgent, HTTPConnectionPool, \
+    ResponseDone, PotentialDataLoss, ResponseFailed, ResponseNeverReceived, \
+    readBody
+from twisted.web.error import Error
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+from .metrics import metrics
+from .misc import monotonic
+
+class _FileWriter(Protocol):
+    """
+    Writes a response body of *length* bytes (``None`` if unknown)
+    to a file.
+    """
+
+    def __init__(self, path, finished, length, drain_limit):
+        self._path = path
+        self._finished = finished
+        self._remaining = length
+        self._drain_limit = drain_limit
+        self._file = open(path, "wb")
+
+    def dataReceived(self, data):
+        if self._file is None:
+            # Cancelled, the rest of the body is discarded
+            return
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        self._file.write(data)
+
+    def connectionLost(self, reason):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self._finished.callback(self._path)
+        else:
+            self._finished.errback(reason)
+
+    def cancel(self, finished):
+        self._file.close()
+        self._file = None
+        if self._remaining is not None \
+                and self._remaining <= self._drain_limit:
+            # Reading the rest is cheaper than a new connection,
+            # the connection returns to the pool when done
+            metrics.count("http.fetch_drained")
+            return
+        # Aborts the connection, it cannot be reused
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+
+class HTTPFetcher(object):
+    """
+    Downloads resources using persistent HTTP/1.1 connections (at most
+    *max_per_host* are kept open for each server). At most
+    *max_concurrent* downloads are active at the same time, further
+    requests wait for a download to complete. A download fails if it
+    takes longer than *timeout* seconds after it has been started
+    (the time spent waiting isn't counted).
+
+    Downloads may be cancelled (e.g. because the picture isn't needed
+    any more) by cancelling the returned deferred. If at most
+    *drain_limit* bytes of the body are still to be received, they
+    are read and discarded, so that the connection can be reused.
+    Else the connection is closed.
+
+    Must only be used from the main thread.
+    """
+
+    def __init__(self, max_per_host=2, max_concurrent=2, timeout=30,
+                 connect_timeout=10, drain_limit=256*1024, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.timeout = timeout
+        self.drain_limit = drain_limit
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max_per_host
+        self._agent = RedirectAgent(Agent(reactor, pool=self._pool,
+                                          connectTimeout=connect_timeout))
+        self._semaphore = defer.DeferredSemaphore(max_concurrent)
+        self._queued = set()
+
+    @property
+    def waiting(self):
+        """
+        The number of downloads waiting to be started.
+        """
+        return len(self._semaphore.waiting)
+
+    def download(self, url, path):
+        """
+        Download *url* to the file *path*. Returns a deferred that
+        fires with *path*. Can be used as replacement for
+        ``twisted.web.client.downloadPage``.
+        """
+        started = monotonic()
+        result = self._semaphore.acquire()
+        self._queued.add(result)
+        def _acquired(_):
+            self._queued.discard(result)
+            d = self._agent.request("GET", url, Headers())
+            d.addCallback(self._receive, path)
+            d.addTimeout(self.timeout, self._reactor)
+            d.addBoth(self._release)
+            return d
+        def _dequeued(failure):
+            # Cancelled while waiting
+            self._queued.discard(result)
+            return failure
+        result.addCallbacks(_acquired, _dequeued)
+        result.addBoth(self._record, started)
+        return result
+
+    def queued(self, d):
+        """
+        Whether the download *d* (as returned by :meth:`download`)
+        is still waiting to be started.
+        """
+        return d in self._queued
+
+    def _release(self, result):
+        self._semaphore.release()
+        return result
+
+    def _receive(self, response, path):
+        if response.code != 200:
+            def _error(body):
+                raise Error(response.code, response.phrase, body)
+            return readBody(response).addCallback(_error)
+        finished = defer.Deferred(lambda d: writer.cancel(d))
+        length = response.length
+        if length is UNKNOWN_LENGTH:
+            length = None
+        writer = _FileWriter(path, finished, length, self.drain_limit)
+        response.deliverBody(writer)
+        return finished
+
+    def _record(self, result, started):
+        if isinstance(result, failure.Failure):
+            if result.check(ResponseFailed, ResponseNeverReceived) \
+                    and [reason for reason in result.value.reasons
+                         if reason.check(defer.CancelledError)]:
+                # Cancelled while the request was being processed
+                result = failure.Failure(defer.CancelledError())
+            if result.check(defer.CancelledError):
+                metrics.count("http.fetch_cancelled")
+            else:
+                metrics.count("http.fetch_errors")
+        else:
+            metrics.observe("http.fetch", monotonic() - started)
+        return result
+
+    def close(self):
+        """
+        Close the persistent connections.
+        """
+        return self._pool.closeCachedConnections()
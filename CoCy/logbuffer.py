@@ -0,0 +1,159 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from collections import deque
+from threading import Thread, Condition
+import logging
+import sys
+from circuits_bricks.app.logger import log
+
+LOGGER_NAME = "CoCy"
+"""The name of the logger created by the application."""
+
+_logger = logging.getLogger(LOGGER_NAME)
+
+def log_enabled(level):
+    """
+    Returns ``True`` if messages with the given level are written to
+    the log. Checking this before creating a message avoids the costs
+    of formatting it and of creating a :class:`log` event.
+    """
+    return _logger.isEnabledFor(level)
+
+def log_event(level, message, *args, **kwargs):
+    """
+    Returns a :class:`log` event for the message (formatted with *args*)
+    or ``None`` if the level is disabled. The event's source information
+    refers to the caller (or the caller's caller etc. if keyword argument
+    *depth* is greater than 1).
+    """
+    if not _logger.isEnabledFor(level):
+        return None
+    if args:
+        message = message % args
+    event = log(level, message)
+    try:
+        frame = sys._getframe(kwargs.get("depth", 1))
+        event.file_name, event.line_number, event.func \
+            = (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+    except ValueError:
+        pass
+    return event
+
+
+class BufferedHandler(logging.Handler):
+    """
+    A handler that passes records to a target handler from a background
+    thread. Records are written in batches, at the latest after
+    *flush_interval* seconds or when *batch_size* records have been
+    collected. The *capacity* most recent records are additionally
+    kept in memory and can be retrieved with :meth:`recent`.
+    """
+
+    def __init__(self, target, flush_interval=2.0, batch_size=50,
+                 capacity=200, max_pending=1000):
+        logging.Handler.__init__(self)
+        self._target = target
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = []
+        self._recent = deque(maxlen=capacity)
+        self._cond = Condition()
+        self._closing = False
+        self.dropped = 0
+        self._writer = Thread(target=self._write_loop, name="CoCyLogWriter")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, record):
+        with self._cond:
+            self._recent.append(record)
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                if not self._pending and not self._closing:
+                    self._cond.wait(self.flush_interval)
+                batch = self._pending
+                self._pending = []
+                closing = self._closing
+            self._write(batch)
+            if closing:
+                return
+
+    def _write(self, batch):
+        if not batch:
+            return
+        for record in batch:
+            try:
+                if record.levelno >= self._target.level:
+                    self._target.handle(record)
+            except Exception:
+                self.handleError(record)
+        self._target.flush()
+
+    def recent(self):
+        """
+        Returns the most recent records, formatted by the target
+        handler's formatter.
+        """
+        with self._cond:
+            records = list(self._recent)
+        return [self._target.format(record) for record in records]
+
+    def flush(self):
+        with self._cond:
+            batch = self._pending
+            self._pending = []
+        self._write(batch)
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._writer.join(self.flush_interval + 1)
+        self.flush()
+        self._target.close()
+        logging.Handler.close(self)
+
+
+def buffer_handlers(name=LOGGER_NAME, **kwargs):
+    """
+    Replace the handlers of the logger *name* with
+    :class:`BufferedHandler`\ s that forward to them. Returns the new
+    handlers.
+    """
+    logger = logging.getLogger(name)
+    buffered = []
+    for handler in list(logger.handlers):
+        if isinstance(handler, BufferedHandler):
+            continue
+        logger.removeHandler(handler)
+        wrapper = BufferedHandler(handler, **kwargs)
+        logger.addHandler(wrapper)
+        buffered.append(wrapper)
+    return buffered
@@ -0,0 +1,135 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from collections import OrderedDict
+from xml.etree import ElementTree
+from xml.etree.ElementTree import QName
+from cocy.upnp import DIDL_LITE_NS
+
+IMAGE = "image"
+AUDIO = "audio"
+VIDEO = "video"
+UNSUPPORTED = "unsupported"
+
+SUPPORTED_TYPES = [
+    ("audio/mpeg", AUDIO), ("audio/ogg", AUDIO),
+    ("video/MP2T", VIDEO), ("audio/mp4", AUDIO),
+    ("application/mp4", VIDEO), ("video/mp4", VIDEO),
+    ("audio/3gpp", AUDIO), ("video/3gpp", VIDEO),
+    ("audio/3gpp2", AUDIO), ("video/3gpp2", VIDEO),
+    ("application/vnd.ms-asf", VIDEO),
+    ("image/jpeg", IMAGE), ("image/gif", IMAGE),
+    ("image/png", IMAGE),
+    # those are not officially asigned!
+    ("video/mpeg", VIDEO), ("video/avi", VIDEO),
+    ("image/bmp", IMAGE)]
+
+_RES_PATH = str(QName(DIDL_LITE_NS, "item")) \
+    + "/" + str(QName(DIDL_LITE_NS, "res"))
+
+class MediaInfo(object):
+    """
+    What the renderer needs to know about a source.
+    """
+
+    def __init__(self, mimetype, kind):
+        self.mimetype = mimetype
+        self.kind = kind
+
+
+class MediaTypeRegistry(object):
+    """
+    Maps MIME types and protocolInfo strings to the kind of handling
+    that they require and provides the sink protocol infos. MIME
+    types that aren't registered are classified by their major type.
+    """
+
+    def __init__(self, types=SUPPORTED_TYPES):
+        self._kinds = dict((mimetype.lower(), kind)
+                           for mimetype, kind in types)
+        self._protocol_infos = ["http-get:*:%s:*" % mimetype
+                                for mimetype, _ in types]
+        self._by_protocol_info = dict()
+
+    @property
+    def protocol_infos(self):
+        return self._protocol_infos
+
+    def kind(self, mimetype):
+        if mimetype is None:
+            return UNSUPPORTED
+        mimetype = mimetype.lower()
+        kind = self._kinds.get(mimetype)
+        if kind is None:
+            kind = mimetype.split("/")[0]
+            if kind not in (IMAGE, AUDIO, VIDEO):
+                kind = UNSUPPORTED
+        return kind
+
+    def classify(self, protocol_info):
+        """
+        Returns the :class:`MediaInfo` for *protocol_info*.
+        """
+        info = self._by_protocol_info.get(protocol_info)
+        if info is None:
+            parts = (protocol_info or "").split(":")
+            mimetype = parts[2] if len(parts) > 2 else None
+            info = MediaInfo(mimetype, self.kind(mimetype))
+            self._by_protocol_info[protocol_info] = info
+        return info
+
+
+class MetadataCache(object):
+    """
+    Keeps the :class:`MediaInfo` derived from the DIDL-Lite meta data
+    of the most recently used sources, so that the meta data has
+    to be parsed only once per source.
+    """
+
+    def __init__(self, registry, max_entries=16):
+        self._registry = registry
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def info(self, uri, meta_data):
+        """
+        Returns the :class:`MediaInfo` for the source with the given
+        *uri* and *meta_data*.
+        """
+        entry = self._entries.pop(uri, None)
+        if entry is None or entry[0] != meta_data:
+            entry = (meta_data, self._parse(meta_data))
+        self._entries[uri] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry[1]
+
+    def _parse(self, meta_data):
+        protocol_info = None
+        try:
+            data = meta_data
+            if isinstance(data, unicode):
+                data = data.encode("utf-8")
+            res = ElementTree.fromstring(data).find(_RES_PATH)
+            if res is not None:
+                protocol_info = res.get("protocolInfo")
+        except Exception:
+            pass
+        return self._registry.classify(protocol_info)
@@ -0,0 +1,201 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from bisect import bisect_left
+from functools import update_wrapper
+from threading import Lock
+from circuits.core.timers import Timer as CircuitsTimer
+from circuits_bricks.core.timers import Timer as BricksTimer
+from .misc import monotonic
+
+BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+          1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+"""Default upper bounds (in seconds) of the histogram buckets."""
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets. Percentiles are estimated by
+    interpolating within the bucket that contains the requested rank.
+    """
+
+    def __init__(self, bounds=BOUNDS):
+        self._bounds = bounds
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._buckets = [0] * (len(self._bounds) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.min = None
+            self.max = None
+
+    def observe(self, value):
+        with self._lock:
+            self._buckets[bisect_left(self._bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = p / 100.0 * self.count
+            seen = 0
+            for i, n in enumerate(self._buckets):
+                if n > 0 and seen + n >= rank:
+                    low = max(self._bounds[i - 1] if i > 0 else self.min,
+                              self.min)
+                    high = min(self._bounds[i] if i < len(self._bounds)
+                               else self.max, self.max)
+                    return low + (high - low) * (rank - seen) / n
+                seen += n
+            return self.max
+
+    def snapshot(self):
+        result = { "count": self.count, "sum": self.sum,
+                   "min": self.min, "max": self.max,
+                   "mean": self.sum / self.count if self.count else None }
+        for p in (50, 90, 99):
+            result["p%d" % p] = self.percentile(p)
+        return result
+
+
+class Metrics(object):
+    """
+    A registry for histograms, counters and gauges (functions that
+    are evaluated when a snapshot is taken).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = dict()
+        self._counters = dict()
+        self._gauges = dict()
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, value):
+        self.histogram(name).observe(value)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name, func):
+        """
+        Register a function that provides the current value of *name*.
+        """
+        with self._lock:
+            self._gauges[name] = func
+
+    def reset(self):
+        """
+        Forget all recorded values (gauges remain registered).
+        """
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        with self._lock:
+            histograms = dict(self._histograms)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        values = dict()
+        for name, func in gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                values[name] = "error: %s" % type(e).__name__
+        return { "histograms": dict((name, h.snapshot())
+                                    for name, h in histograms.items()),
+                 "counters": counters,
+                 "gauges": values }
+
+    def text(self):
+        """
+        Returns the snapshot as lines of ``name value`` pairs.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, values in sorted(snapshot["histograms"].items()):
+            for key, value in sorted(values.items()):
+                lines.append("%s.%s %s" % (name, key, value))
+        for kind in ("counters", "gauges"):
+            for name, value in sorted(snapshot[kind].items()):
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+"""The registry used by CoCy."""
+
+def timed(name, registry=None):
+    """
+    Decorator that records the execution time of the decorated
+    function in histogram *name*. When used with a handler,
+    it must be applied before (i.e. below) ``@handler``.
+    """
+    def decorator(f):
+        def wrapper(*args, **kwargs):
+            started = monotonic()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                (registry or metrics).observe(name, monotonic() - started)
+        update_wrapper(wrapper, f)
+        return wrapper
+    return decorator
+
+def _tree_counts(root):
+    # Components, handlers and timers in the tree below root
+    components = handlers = timers = 0
+    pending = [root]
+    while pending:
+        component = pending.pop()
+        components += 1
+        handlers += sum(len(methods) for methods
+                        in list(component._handlers.values()))
+        if isinstance(component, (CircuitsTimer, BricksTimer)):
+            timers += 1
+        pending.extend(list(component.components))
+    return components, handlers, timers
+
+def tree_gauges(root, registry=None):
+    """
+    Register gauges ``tree.components``, ``tree.handlers`` and
+    ``tree.timers`` with the current number of components, handlers
+    and timers in the component tree *root*. Numbers that keep
+    growing indicate components that are never unregistered.
+    """
+    for i, name in enumerate(("components", "handlers", "timers")):
+        (registry or metrics).gauge("tree." + name,
+                                    lambda i=i: _tree_counts(root)[i])
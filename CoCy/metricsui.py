@@ -0,0 +1,53 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+import json
+import logging
+from circuits.web import Controller
+from .logbuffer import LOGGER_NAME
+from .metrics import metrics
+
+class MetricsController(Controller):
+    """
+    Makes the metrics available as ``/metrics`` (JSON), ``/metrics/text``
+    and the most recent log records as ``/metrics/log``.
+    """
+
+    channel = "/metrics"
+
+    def __init__(self, registry=None, *args, **kwargs):
+        super(MetricsController, self).__init__(*args, **kwargs)
+        self._registry = registry or metrics
+
+    def index(self, *args, **kwargs):
+        self.response.headers["Content-Type"] = "application/json"
+        return json.dumps(self._registry.snapshot(), indent=1, sort_keys=True)
+
+    def text(self, *args, **kwargs):
+        self.response.headers["Content-Type"] = "text/plain"
+        return self._registry.text()
+
+    def log(self, *args, **kwargs):
+        self.response.headers["Content-Type"] = "text/plain"
+        lines = []
+        for handler in logging.getLogger(LOGGER_NAME).handlers:
+            if hasattr(handler, "recent"):
+                lines.extend(handler.recent())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,186 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from collections import OrderedDict
+from twisted.internet import defer
+from twisted.python import failure
+from httpfetch import HTTPFetcher
+from .misc import remove_files
+import hashlib
+import os
+
+class _Entry(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.decoded = None
+
+
+class PictureCache(object):
+    """
+    A cache for pictures, keyed by their URL. The cache keeps the
+    downloaded files (up to *max_bytes* in total) and the decoded
+    pictures of the most recently used entries (up to *max_decoded*),
+    evicting the least recently used ones. Concurrent requests for
+    the same URL share a single download, which is cancelled if all
+    requests for it have been cancelled before it was started. A
+    download that has been started completes into the cache (its
+    connection can then be reused). Downloads use an
+    :class:`~.httpfetch.HTTPFetcher` unless another *fetcher* is
+    given. Files left in *directory* by a previous run are removed
+    (the directory is usually in RAM).
+
+    Must only be used from the main thread.
+    """
+
+    def __init__(self, directory="/tmp/picviewer", max_bytes=16*1024*1024,
+                 max_decoded=3, fetcher=None):
+        self._directory = directory
+        self.max_bytes = max_bytes
+        self.max_decoded = max_decoded
+        self._fetcher = fetcher if fetcher is not None else HTTPFetcher()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._in_flight = dict()
+        self._downloads = dict()
+        self.hits = 0
+        self.misses = 0
+        # Files from previous runs are unknown to the index and
+        # would never be evicted
+        remove_files(self._directory)
+
+    def _path(self, url, extension):
+        return os.path.join(self._directory, "%s%s"
+                            % (hashlib.md5(url).hexdigest(), extension or ""))
+
+    def _touch(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._entries[url] = entry
+        return entry
+
+    def fetch(self, url, extension=None):
+        """
+        Returns a deferred that fires with the name of a local file
+        with the content of *url*.
+        """
+        entry = self._touch(url)
+        if entry is not None and os.path.exists(entry.path):
+            self.hits += 1
+            return defer.succeed(entry.path)
+        if entry is not None:
+            self._remove(url)
+        waiting = self._in_flight.get(url)
+        if waiting is None:
+            self.misses += 1
+            waiting = self._in_flight[url] = []
+            self._download(url, self._path(url, extension))
+        d = defer.Deferred(lambda d: self._cancel(url, d))
+        waiting.append(d)
+        return d
+
+    def _cancel(self, url, d):
+        waiting = self._in_flight.get(url, [])
+        if d in waiting:
+            waiting.remove(d)
+        download = self._downloads.get(url)
+        if not waiting and download is not None \
+                and self._fetcher.queued(download):
+            # Nobody interested any more
+            download.cancel()
+
+    def _download(self, url, path):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        part = path + ".part"
+        def _done(result):
+            os.rename(part, path)
+            self._add(url, path, os.path.getsize(path))
+            return path
+        def _failed(fail):
+            if os.path.exists(part):
+                os.remove(part)
+            return fail
+        d = self._fetcher.download(url, part)
+        self._downloads[url] = d
+        d.addCallbacks(_done, _failed)
+        d.addBoth(self._deliver, url)
+
+    def _deliver(self, result, url):
+        self._downloads.pop(url, None)
+        for d in self._in_flight.pop(url, []):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _add(self, url, path, size):
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[url] = _Entry(path, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        if os.path.exists(entry.path):
+            os.remove(entry.path)
+
+    def decoded(self, url):
+        """
+        Returns the decoded picture for *url* or ``None``.
+        """
+        entry = self._touch(url)
+        if entry is None or entry.decoded is None:
+            return None
+        self.hits += 1
+        return entry.decoded
+
+    def store_decoded(self, url, picture):
+        """
+        Keep the decoded *picture* for *url*. The picture is discarded
+        if the downloaded file has been evicted already.
+        """
+        entry = self._touch(url)
+        if entry is None:
+            return
+        entry.decoded = picture
+        # Only the most recently used entries keep decoded pictures
+        kept = 0
+        for entry in reversed(self._entries.values()):
+            if entry.decoded is None:
+                continue
+            kept += 1
+            if kept > self.max_decoded:
+                entry.decoded = None
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def clear(self):
+        for url in list(self._entries):
+            self._remove(url)
@@ -10,14 +10,42 @@ from Components.Pixmap import Pixmap
 from Components.AVSwitch import AVSwitch
 from enigma import ePicLoad, getDesktop
 from Components.ActionMap import ActionMap
+from twisted.internet import defer
 import mimetypes
-from twisted.web.client import downloadPage
+from piccache import PictureCache
+from downscale import Downscaler, DownscaleError, available as can_downscale
+from metrics import metrics
+from misc import monotonic
 
 class PictureScreen(Screen):
+    """
+    Shows pictures. Up to *preload_depth* pictures that are going to be
+    shown next can be announced with :meth:`preload`. They are
+    downloaded and decoded (using a second decoder) while the current
+    picture is shown, showing them is then just a pixmap swap.
 
-    def __init__(self, session):
+    If *downscale* is set, pictures larger than the screen are
+    downscaled by worker processes before being decoded.
+    """
+
+    def __init__(self, session, cache=None, preload_depth=1,
+                 downscale=False):
         print "[PictureScreen] __init__\n"
         self.closed = False
+        self._cache = cache if cache is not None else PictureCache()
+        # Decoded pictures are kept for the current and the preloaded ones
+        self._cache.max_decoded = max(self._cache.max_decoded,
+                                      preload_depth + 1)
+        self._url = None
+        # URL being decoded by PicLoad and the decode waiting for it
+        self._decoding = None
+        self._queued = None
+        self._requested = None
+        self._preload_depth = preload_depth
+        self._preloads = []
+        self._preloading = None
+        self._scaling = None
+        self._fetching = None
         self.size_w = size_w = getDesktop(0).size().width()
         self.size_h = size_h = getDesktop(0).size().height()
         space = 0
@@ -43,24 +71,147 @@ class PictureScreen(Screen):
         self.PicLoad = ePicLoad()
         self["pic"] = Pixmap()
         self.PicLoad.PictureData.get().append(self.DecodePicture)
+        self.PreLoad = ePicLoad()
+        self.PreLoad.PictureData.get().append(self.DecodePreloaded)
+        self._downscaler = None
+        if downscale:
+            if can_downscale():
+                self._downscaler = Downscaler(size_w, size_h)
+            else:
+                print "[PictureScreen] No imaging library, not downscaling"
         # self.onLayoutFinish.append(self.ShowPicture)
         
     def loadPicture(self, picUrl, mimetype, on_showing = None):
+        if self._fetching is not None and picUrl != self._url:
+            # Skipped before downloaded
+            self._fetching.cancel()
+        self._fetching = None
         self._on_showing = on_showing
+        self._url = picUrl
+        self._requested = monotonic()
+        if self._scaling is not None:
+            # Skipped before downscaled
+            self._scaling.cancel()
+            self._scaling = None
+        ptr = self._cache.decoded(picUrl)
+        if ptr is not None:
+            metrics.count("picture.decoded_hits")
+            self._setPicture(ptr)
+            return
+        if picUrl == self._preloading:
+            # Shown when the preload has completed
+            return
+        extension = mimetypes.guess_extension(mimetype, strict=False)
+        print "Start loading", picUrl
+        self._fetching = self._cache.fetch(picUrl, extension)
+        self._fetching.addCallbacks(self._onPictureReady,
+                                    self._onPictureLoadFailed,
+                                    callbackArgs=(picUrl,))
+
+    def preload(self, picUrl, mimetype):
+        """
+        Download and decode the picture from *picUrl* in advance.
+        Only the most recently announced pictures are kept in the queue.
+        """
+        if self._preload_depth <= 0 or picUrl == self._url \
+                or picUrl == self._preloading \
+                or picUrl in [url for url, _ in self._preloads] \
+                or self._cache.decoded(picUrl) is not None:
+            return
+        self._preloads.append((picUrl, mimetype))
+        del self._preloads[:-self._preload_depth]
+        self._nextPreload()
+
+    def _nextPreload(self):
+        if self._preloading is not None or not self._preloads:
+            return
+        picUrl, mimetype = self._preloads.pop(0)
+        self._preloading = picUrl
         extension = mimetypes.guess_extension(mimetype, strict=False)
-        self._imageFile = "%s%s" % ("/tmp/picviewer", extension)
-        print "Start downloading", picUrl, "to", self._imageFile
-        d = downloadPage(picUrl, self._imageFile)
-        d.addCallbacks(self._onPictureReady, self._onPictureLoadFailed)
+        d = self._cache.fetch(picUrl, extension)
+        d.addCallbacks(self._onPreloadReady, self._onPreloadFailed,
+                       callbackArgs=(picUrl, extension),
+                       errbackArgs=(picUrl, extension))
+
+    def _onPreloadReady(self, imageFile, picUrl, extension):
+        d = self._scaled(imageFile)
+        d.addCallbacks(self._onPreloadScaled, self._onPreloadFailed,
+                       errbackArgs=(picUrl, extension))
+
+    def _onPreloadScaled(self, imageFile):
+        self._setPara(self.PreLoad)
+        self.PreLoad.startDecode(imageFile)
 
-    def _onPictureReady(self, nothing):
-        self.showPicture(self._imageFile)
+    def _onPreloadFailed(self, failure, picUrl, extension):
+        self._preloading = None
+        if picUrl == self._url:
+            if failure.check(defer.CancelledError):
+                # Not preloaded after all, load as usual
+                self._fetching = self._cache.fetch(picUrl, extension)
+                self._fetching.addCallbacks(self._onPictureReady,
+                                            self._onPictureLoadFailed,
+                                            callbackArgs=(picUrl,))
+            else:
+                self._onPictureLoadFailed(failure)
+        self._nextPreload()
 
-    def _onPictureLoadFailed(self):
-        print "Loading picture failed!"
+    def DecodePreloaded(self, PicInfo = ""):
+        ptr = self.PreLoad.getData()
+        picUrl = self._preloading
+        self._preloading = None
+        self._cache.store_decoded(picUrl, ptr)
+        if picUrl == self._url and self._decoding != picUrl:
+            # Requested while being preloaded
+            self._setPicture(ptr)
+        self._nextPreload()
 
-    def showPicture(self, picPath):
-        self.PicLoad.setPara([
+    def _onPictureReady(self, imageFile, picUrl):
+        self._fetching = None
+        if picUrl != self._url:
+            # Superseded by another picture
+            return
+        self._scaling = self._scaled(imageFile)
+        self._scaling.addCallbacks(self._onPictureScaled,
+                                   self._onPictureLoadFailed,
+                                   callbackArgs=(picUrl,))
+
+    def _onPictureScaled(self, imageFile, picUrl):
+        self._scaling = None
+        if picUrl != self._url:
+            return
+        self.showPicture(imageFile, picUrl)
+
+    def _scaled(self, imageFile):
+        # Deferred for the file to be decoded instead of imageFile
+        if self._downscaler is None:
+            return defer.succeed(imageFile)
+        def _failed(failure):
+            failure.trap(DownscaleError)
+            print "Downscaling picture failed!", failure.getErrorMessage()
+            return imageFile
+        return self._downscaler.scale(imageFile).addErrback(_failed)
+
+    def _onPictureLoadFailed(self, failure):
+        if failure.check(defer.CancelledError):
+            return
+        print "Loading picture failed!", failure.getErrorMessage()
+
+    def showPicture(self, picPath, picUrl=None):
+        if picUrl is None:
+            picUrl = self._url
+        if self._decoding is not None:
+            # The decoder doesn't accept another picture while busy,
+            # only the latest request is decoded when it has finished
+            self._queued = (picPath, picUrl)
+            return
+        self._decoding = picUrl
+        self._setPara(self.PicLoad)
+        if self.PicLoad.startDecode(picPath):
+            print "[PictureScreen] Decoder busy, cannot show", picUrl
+            self._decoding = None
+
+    def _setPara(self, picLoad):
+        picLoad.setPara([
                               self["pic"].instance.size().width(),
                               self["pic"].instance.size().height(),
                               self.Scale[0],
@@ -68,10 +219,29 @@ class PictureScreen(Screen):
                               0,
                               1,
                               "#002C2C39"])
-        self.PicLoad.startDecode(picPath)
 
     def DecodePicture(self, PicInfo = ""):
         ptr = self.PicLoad.getData()
+        picUrl = self._decoding
+        self._decoding = None
+        if picUrl is not None:
+            self._cache.store_decoded(picUrl, ptr)
+        if picUrl == self._url:
+            self._setPicture(ptr)
+        queued = self._queued
+        self._queued = None
+        if queued is not None and queued[1] == self._url:
+            ptr = self._cache.decoded(queued[1])
+            if ptr is not None:
+                self._setPicture(ptr)
+            else:
+                self.showPicture(*queued)
+
+    def _setPicture(self, ptr):
         self["pic"].instance.setPixmap(ptr)
+        if self._requested is not None:
+            metrics.observe("picture.time_to_display",
+                            monotonic() - self._requested)
+            self._requested = None
         if self._on_showing is not None:
             self._on_showing()
@@ -20,7 +20,6 @@
 """
 from Plugins.Plugin import PluginDescriptor
 from Components.ServiceEventTracker import ServiceEventTracker
-from Plugins.SystemPlugins.CoCy.server import start
 
 def plugin_start(reason, **kwargs):
 	print "[CoCy] reason = " + str(reason)
@@ -32,6 +31,8 @@ def plugin_start(reason, **kwargs):
 		ServiceEventTracker.oldRef = None
 		print "[CoCy] Added missing attribute oldRef to ServiceEventTracker"
 
+	# Imported here to keep loading the plugin (at boot) cheap
+	from Plugins.SystemPlugins.CoCy.server import start
 	start(session)
 
 def Plugins(**kwargs):
@@ -0,0 +1,179 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from .misc import monotonic
+from collections import OrderedDict
+from threading import Lock
+
+class PositionTracker(object):
+    """
+    Keeps the last position obtained from the player together with
+    the (monotonic) time when it was obtained. While playing, the
+    current position is extrapolated from this sample. A new sample
+    is only required after :attr:`resync_interval` seconds or after
+    the sample has been invalidated (seek, pause, start of a new service).
+
+    If *metrics* (a :class:`~.metrics.Metrics`) is given, the number
+    of resyncs and extrapolations and the last and maximum drift
+    are provided as ``position.*`` gauges.
+
+    Samples are taken on the main thread, while positions are usually
+    queried from the circuits thread. The sample is therefore kept
+    as a tuple that is replaced as a whole.
+    """
+
+    def __init__(self, resync_interval=5.0, clock=monotonic, metrics=None):
+        self.resync_interval = resync_interval
+        self._clock = clock
+        self._sample = None
+        self.resyncs = 0
+        self.extrapolations = 0
+        self.last_drift = None
+        self.max_drift = 0.0
+        if metrics is not None:
+            for name in ("resyncs", "extrapolations",
+                         "last_drift", "max_drift"):
+                metrics.gauge("position." + name,
+                              lambda name=name: getattr(self, name))
+
+    def _extrapolate(self, sample, now):
+        position, taken, playing = sample
+        if not playing:
+            return position
+        return position + (now - taken)
+
+    def sample(self, position, playing=True):
+        """
+        Record a position obtained from the player. If a previous sample
+        exists, the difference between the extrapolated and the actual
+        position is recorded as drift.
+        """
+        now = self._clock()
+        previous = self._sample
+        if previous is not None and position is not None:
+            drift = abs(self._extrapolate(previous, now) - position)
+            self.last_drift = drift
+            if drift > self.max_drift:
+                self.max_drift = drift
+        self.resyncs += 1
+        if position is None:
+            self._sample = None
+        else:
+            self._sample = (position, now, playing)
+
+    def reset(self, position, playing=True):
+        """
+        Start over from *position* (e.g. the target of a seek). Unlike
+        :meth:`sample`, the jump isn't recorded as drift or resync.
+        """
+        self._sample = (position, self._clock(), playing)
+
+    def invalidate(self):
+        """
+        Forget the current sample, the next query requires a resync.
+        """
+        self._sample = None
+
+    def needs_resync(self):
+        sample = self._sample
+        return sample is None \
+            or self._clock() - sample[1] >= self.resync_interval
+
+    def position(self):
+        """
+        Returns the extrapolated position or ``None`` if no sample
+        is available.
+        """
+        sample = self._sample
+        if sample is None:
+            return None
+        self.extrapolations += 1
+        return self._extrapolate(sample, self._clock())
+
+
+class DurationCache(object):
+    """
+    Caches the duration of sources. Failed lookups (e.g. streams
+    that are not seekable yet) are recorded as well and are only
+    retried after a backoff that doubles with every failure (up to
+    *max_backoff* seconds). Entries are invalidated when the player
+    reports new information about the service. At most *max_entries*
+    sources are remembered.
+
+    May be used from any thread.
+    """
+
+    def __init__(self, initial_backoff=1.0, max_backoff=60.0,
+                 max_entries=32, clock=monotonic):
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def lookup(self, key):
+        """
+        Returns a tuple ``(found, duration)``. If *found* is ``True``,
+        *duration* is the cached duration (``None`` for a failed lookup
+        whose backoff hasn't expired yet).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return (False, None)
+        duration, retry_at, _ = entry
+        if duration is None and self._clock() >= retry_at:
+            return (False, None)
+        return (True, duration)
+
+    def store(self, key, duration):
+        """
+        Record the result of a lookup, ``None`` meaning that the
+        duration couldn't be obtained.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if duration is not None:
+                self._entries[key] = (duration, None, 0)
+            else:
+                backoff = self.initial_backoff
+                if entry is not None and entry[0] is None:
+                    backoff = min(entry[2] * 2, self.max_backoff)
+                self._entries[key] = (None, self._clock() + backoff, backoff)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None, known_only=False):
+        """
+        Forget the entry for *key* or all entries if *key* is ``None``.
+        If *known_only* is set, failed lookups are kept, so that their
+        backoff continues to grow.
+        """
+        with self._lock:
+            if key is None:
+                keys = list(self._entries)
+            else:
+                keys = [key]
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and not (known_only
+                                              and entry[0] is None):
+                    del self._entries[key]
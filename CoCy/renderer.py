@@ -20,44 +20,141 @@
 """
 from enigma import eDVBVolumecontrol, iPlayableService, eServiceReference
 from circuits.core.handlers import handler
-from cocy.providers import Manifest, MediaPlayer, combine_events
+from cocy.providers import Manifest, MediaPlayer, combine_events, \
+    provider_updated
 from Components.ServiceEventTracker import ServiceEventTracker
-from circuits_bricks.core.timers import Timer
 from circuits.core.events import Event
-from circuits_bricks.app.logger import log
+from .logbuffer import log_enabled, log_event
+from .metrics import metrics, timed
+from urlparse import urlparse
 import logging
+from threading import Lock
 from socket import gethostname
-from xml.etree.ElementTree import QName
-from picviewer import PictureScreen
 from .ebrigde import blockingCallOnMainThread, callOnMainThread
+from .position import PositionTracker, DurationCache
+from .misc import monotonic
+from .mediatypes import MediaTypeRegistry, MetadataCache, IMAGE, AUDIO, \
+    VIDEO, UNSUPPORTED
+from .seeking import SeekScheduler
+from .volume import VolumeScheduler
+from .delayed import DelayedActions
 
 class player_playing(Event):
     pass
 
+class volume_applied(Event):
+    pass
+
+class _PreparedSource(object):
+    """
+    A source (usually the next one) with everything that can be
+    done before it is actually played.
+    """
+
+    def __init__(self, uri, media_info, service):
+        self.uri = uri
+        self.media_info = media_info
+        self.service = service
+
+class _PlayerTransaction(object):
+    """
+    The main thread work requested by one or more events that
+    hasn't been executed yet. Later requests are merged into the
+    pending work, so that only the effective result is applied
+    when the transaction is eventually run on the main thread
+    (in the order stop, source, play, pause).
+    """
+
+    def __init__(self):
+        self.stop = False
+        self.pause = False
+        self.source = None
+        self.next = None
+        self.play = False
+        # Play only withdraws a pause that hasn't been executed
+        self.pause_withdrawn = False
+
+    def add_stop(self):
+        # Stopping discards anything requested before
+        self.stop = True
+        self.pause = False
+        self.play = False
+        self.pause_withdrawn = False
+
+    def add_pause(self):
+        if self.pause_withdrawn:
+            # Pause, play, pause: still a pause
+            self.play = False
+            self.pause_withdrawn = False
+        self.pause = True
+
+    def add_source(self, uri):
+        self.source = uri
+        self.pause_withdrawn = False
+
+    def add_next(self, uri, meta_data):
+        self.next = (uri, meta_data)
+
+    def add_play(self):
+        # A pause that hasn't been executed yet is superseded. If
+        # nothing else has been requested, the player simply goes on.
+        self.pause_withdrawn = self.pause and not self.play \
+            and not self.stop and self.source is None
+        self.pause = False
+        self.play = True
+
 class Enigma2Player(MediaPlayer):
 
     manifest = Manifest("Media Renderer on " + gethostname(),
                         "Media Renderer on " + gethostname())
 
-    def __init__(self, session):
+    def __init__(self, session, position_resync=5.0, warm_next=False,
+                 seek_delay=0.15, volume_interval=0.1, volume_ramp=0,
+                 picture_preload=1, picture_downscale=False,
+                 stream_buffer=0, resume=None, watchdog=None):
 
         super(Enigma2Player, self).__init__(self.manifest)
         self._session = session
         self._old_service_set = False
         self._old_service = None
         self._service = None
+        self._service_uri = None
+        self._next = None
+        self._switched_to = None
+        self._warm_next = warm_next
+        self._picture_preload = picture_preload
+        self._picture_downscale = picture_downscale
+        self._stream_buffer = stream_buffer
+        self._resume = resume
+        self._resume_at = None
+        self._watchdog = watchdog
+        self._switch_started = None
+        self.last_track_switch = None
+        self._play_requested = None
+        # Created on first use
+        self._picDlg = None
+        self._volctrl = None
+        self._proxy = None
+        self._media_types = None
+        self._media_infos = None
         self._pausing = False
-        self._idle_Timer = None
         self._eom = False
         self._seek_offset = 0
+        self._transaction = None
+        self._transaction_lock = Lock()
+        self._position = PositionTracker(position_resync, metrics=metrics)
+        self._durations = DurationCache()
+        self._seeks = SeekScheduler(self._seek, delay=seek_delay,
+                                    metrics=metrics)
+        self._volumes = VolumeScheduler(self._apply_volume, volume_interval,
+                                        volume_ramp, self._hardware_volume,
+                                        metrics=metrics)
+        # All timeouts (closing when idle)
+        self._delayed = DelayedActions(channel=self.channel).register(self)
+        metrics.gauge("renderer.delayed_actions", lambda: len(self._delayed))
         self.onClose = [self._onClose] # Mimic as "screen"
             
         def _init():
-            self._picDlg = self._session.instantiateDialog(PictureScreen)
-            self._volctrl = eDVBVolumecontrol.getInstance()
-            vol = self._volctrl.getVolume()
-            self.volume = vol / 100
-        
             self.__event_tracker = ServiceEventTracker(screen=self, eventmap={
                 iPlayableService.evStart: self._onStart,
                 iPlayableService.evEOF: self._onEOF,
@@ -69,66 +166,225 @@ class Enigma2Player(MediaPlayer):
         callOnMainThread(_init)
 
     def supportedMediaTypes(self):
-        return ["http-get:*:audio/mpeg:*", "http-get:*:audio/ogg:*",
-                "http-get:*:video/MP2T:*", "http-get:*:audio/mp4:*",
-                "http-get:*:application/mp4:*", "http-get:*:video/mp4:*",
-                "http-get:*:audio/3gpp:*", "http-get:*:video/3gpp:*",
-                "http-get:*:audio/3gpp2:*", "http-get:*:video/3gpp2:*",
-                "http-get:*:application/vnd.ms-asf:*", 
-                "http-get:*:image/jpeg:*", "http-get:*:image/gif:*",
-                "http-get:*:image/png:*",
-                # those are not officially asigned!
-                "http-get:*:video/mpeg:*", "http-get:*:video/avi:*",
-                "http-get:*:image/bmp:*"]
+        return self._media_registry().protocol_infos
+
+    def _media_registry(self):
+        if self._media_types is None:
+            self._media_types = MediaTypeRegistry()
+            self._media_infos = MetadataCache(self._media_types)
+        return self._media_types
+
+    def _media_info(self, uri, meta_data):
+        self._media_registry()
+        return self._media_infos.info(uri, meta_data)
+
+    def _pic_dialog(self):
+        # Called from main thread
+        if self._picDlg is None:
+            from picviewer import PictureScreen
+            self._picDlg = self._session.instantiateDialog(
+                PictureScreen, preload_depth=self._picture_preload,
+                downscale=self._picture_downscale)
+        return self._picDlg
+
+    def _volume_control(self):
+        # Called from main thread
+        if self._volctrl is None:
+            self._volctrl = eDVBVolumecontrol.getInstance()
+        return self._volctrl
+
+    def _hardware_volume(self):
+        # Called from main thread
+        return self._volume_control().getVolume() / 100.0
+
+    def _proxied(self, uri, media_info):
+        # Only streams are read ahead, not pictures
+        return bool(self._stream_buffer) and uri.startswith("http://") \
+            and media_info.kind in (AUDIO, VIDEO)
+
+    def _service_ref(self, uri, media_info):
+        # Called from main thread
+        if self._proxied(uri, media_info):
+            # Let the player get the stream from the read ahead proxy
+            if self._proxy is None:
+                from .streamproxy import StreamProxy
+                self._proxy = StreamProxy(buffer_size=self._stream_buffer)
+            uri = self._proxy.url_for(uri)
+        return eServiceReference(4097, 0, uri)
+
+    @property
+    def volume(self):
+        if self._volctrl is None and self._volumes.target() is None:
+            volume = blockingCallOnMainThread(self._hardware_volume)
+            if self._volumes.target() is None:
+                MediaPlayer.volume.fset(self, volume)
+        return MediaPlayer.volume.fget(self)
+
+    @volume.setter
+    def volume(self, volume):
+        MediaPlayer.volume.fset(self, volume)
 
     @property
     def session(self):
         return getattr(self, "_session", None)
 
+    def _busy(self):
+        # Whether non-critical work should be skipped
+        return self._watchdog is not None and self._watchdog.busy()
+
+    def _log(self, level, message, *args):
+        # Nothing is formatted or fired if the level is disabled
+        # (debug messages are dropped while the main loop is busy)
+        if not log_enabled(level):
+            return
+        if level <= logging.DEBUG and self._busy():
+            metrics.count("shed.log")
+            return
+        event = log_event(level, message, *args, depth=2)
+        if event is not None:
+            self.fire(event, "logger")
+
     def _onStart(self):
         # Service event, called by main thread
-        self.fire(log(logging.DEBUG, "Enigma player started"), "logger")
+        if self._switch_started is not None:
+            self.last_track_switch = monotonic() - self._switch_started
+            self._switch_started = None
+            metrics.observe("play.track_switch", self.last_track_switch)
+            self._log(logging.DEBUG, "Track switched in %.3f s",
+                      self.last_track_switch)
+        self._position.invalidate()
+        self._durations.invalidate(self._service_uri)
+        self._log(logging.DEBUG, "Enigma player started")
+        self._resume_at = None
+        if self._resume is not None and self._service is not None \
+                and self._session.nav.getCurrentlyPlayingServiceOrGroup() \
+                    == self._service:
+            # Not for other services (e.g. the restored TV service)
+            self._resume.lookup(self._service_uri) \
+                .addCallback(self._resume_found, self._service_uri)
         self.fire(player_playing())
 
+    def _resume_found(self, position, uri):
+        # Called from main thread
+        if uri != self._service_uri:
+            # Another source started meanwhile
+            return
+        self._resume_at = position
+        self._maybe_resume()
+
+    def _maybe_resume(self):
+        # Called from main thread, seeks to the position where the
+        # source has been left (if the service is seekable yet)
+        if self._resume_at is None:
+            return
+        if self._seek_to(self._resume_at):
+            self._log(logging.DEBUG, "Resuming %s at %s",
+                      self._service_uri, self._resume_at)
+            metrics.count("resume.restored")
+            self._resume_at = None
+
+    def _remember_position(self):
+        # Called from main thread
+        if self._resume is None or not self._service_uri:
+            return
+        seek = self._seekable()
+        if seek is None:
+            return
+        pos = seek.getPlayPosition()
+        if pos[0]:
+            return
+        # Not current_track_duration, which may already be the next source's
+        length = seek.getLength()
+        self._resume.update(self._service_uri,
+                            self._seek_offset + float(pos[1]) / 90000,
+                            None if length[0] else float(length[1]) / 90000)
+
+    def _playing(self):
+        # Record how long it took from the play request to playing
+        requested = self._play_requested
+        self._play_requested = None
+        if requested is None:
+            return
+        elapsed = monotonic() - requested
+        metrics.observe("play.time_to_playing", elapsed)
+        host = urlparse(self._service_uri or "").hostname
+        if host:
+            metrics.observe("play.time_to_playing." + host, elapsed)
+
     @handler("player_playing")
     @combine_events
     def _on_player_playing(self):
-        self.fire(log(logging.DEBUG, "Player playing"), "logger")
+        self._log(logging.DEBUG, "Player playing")
+        self._playing()
         self.state = "PLAYING"
         self.current_track_duration = self._duration()
 
     def _onEOF(self):
         # Service event, called by main thread
-        self.fire(log(logging.DEBUG, "End Of Media from player"), "logger")
+        self._log(logging.DEBUG, "End Of Media from player")
+        if self._resume is not None:
+            self._resume.forget(self._service_uri)
+        self._switch_started = monotonic()
+        self._position.invalidate()
+        prepared = self._next
+        self._next = None
+        if prepared is not None and prepared.service is not None:
+            # Switch to the prepared source right away, the source
+            # update following the end_of_media event is then a no-op.
+            self._service = prepared.service
+            self._service_uri = prepared.uri
+            self._seek_offset = 0
+            self._switched_to = prepared.uri
+            self._log(logging.DEBUG, "Switching to prepared %s", prepared.uri)
+            try:
+                self._session.nav.playService(prepared.service)
+            except Exception as e:
+                self._switched_to = None
+                self._log(logging.ERROR, "Failed to start playing: %s", type(e))
+            else:
+                self.fire(MediaPlayer.end_of_media())
+                return
         self._session.nav.stopService()
         self._eom = True
         self.fire(MediaPlayer.end_of_media())
 
     def _onUpdatedEventInfo(self):
         # Service event, called by main thread
-        self.fire(log(logging.DEBUG, 
-                      "Updated Event Info from player"), "logger")
+        self._log(logging.DEBUG, "Updated Event Info from player")
                                                   
     def _onUpdatedInfo(self):
         # Service event, called by main thread
-        self.fire(log(logging.DEBUG, 
-                      "Updated Info from player"), "logger")
+        self._log(logging.DEBUG, "Updated Info from player")
+        # Live streams send this repeatedly, failed lookups keep
+        # their backoff
+        self._durations.invalidate(self._service_uri, known_only=True)
+        duration = self._duration()
+        if duration is not None and duration != self.current_track_duration:
+            self.current_track_duration = duration
+        self._maybe_resume()
                                                    
     def _onBuffering(self):
         # Service event, called by main thread
-        self.fire(log(logging.DEBUG, 
-                      "Buffering from player"), "logger")
+        self._log(logging.DEBUG, "Buffering from player")
+        stream = self._proxy.last_stream if self._proxy is not None else None
+        if stream is not None:
+            self._log(logging.DEBUG, "Read ahead: %d bytes buffered,"
+                      " %.0f bytes/s, %d underruns", len(stream.buffer),
+                      stream.throughput, stream.underruns)
                                                    
     def _tune_failed(self):
         # Service event, called by main thread
-        self.fire(log(logging.DEBUG, "Tune failed"), "logger")
+        self._log(logging.DEBUG, "Tune failed")
 
     @handler("close_player")
     def _onClose(self, *args, **kwargs):
         def _close():
             print "[CoCy] Closing"
-            if self._picDlg.execing:
+            if self._picDlg is not None and self._picDlg.execing:
                 self._picDlg.close()
+            # The restored service isn't the renderer's source
+            self._service_uri = None
+            self._resume_at = None
             if self._old_service_set and self._old_service:
                 print "[CoCy] Restoring old service " + self._old_service.getName()
                 self._session.nav.playService(self._old_service)
@@ -137,40 +393,148 @@ class Enigma2Player(MediaPlayer):
             self._old_service_set = False
         blockingCallOnMainThread(_close)
                           
+    def _schedule(self, *requests):
+        # Add requests to the pending transaction, schedules its
+        # execution on the main thread if not already done.
+        with self._transaction_lock:
+            transaction = self._transaction
+            schedule = transaction is None
+            if schedule:
+                transaction = self._transaction = _PlayerTransaction()
+            for request in requests:
+                getattr(transaction, "add_" + request[0])(*request[1:])
+        if schedule:
+            callOnMainThread(self._run_transaction)
+
+    @timed("main.transaction")
+    def _run_transaction(self):
+        # Called from main thread
+        with self._transaction_lock:
+            transaction = self._transaction
+            self._transaction = None
+        if transaction is None:
+            return
+        if transaction.stop:
+            # Starting a new service stops the current one anyway
+            self._stop(stop_service=not transaction.play)
+        if transaction.source is not None:
+            self._set_source(transaction.source)
+        if transaction.next is not None:
+            self._prepare_next(*transaction.next)
+        if transaction.play:
+            if transaction.pause_withdrawn and not self._pausing:
+                # Still playing the current source
+                self.fire(player_playing())
+            else:
+                self._play(stop_service=transaction.stop)
+        if transaction.pause:
+            self._pause()
+
+    def _publish_updates(self):
+        # Invoked when evented properties have been changed (from any
+        # thread). The player follows the changes right away. Control
+        # points are notified about every change (even a value set
+        # again, e.g. a repeated source), the UPnP services moderate
+        # their LastChange events themselves.
+        changed = self._provider_changed
+        if not changed:
+            return
+        self._provider_changed = dict()
+        self._apply_changes(changed)
+        self.fire(provider_updated(self, changed))
+
     @handler("provider_updated")
     def _on_provider_updated_handler(self, provider, changed):
+        # Replaces the base class' handler that logs every update,
+        # the changes have already been applied by _publish_updates.
+        pass
+
+    @timed("player.apply_changes")
+    def _apply_changes(self, changed):
+        requests = []
         if "state" in changed and changed["state"] == "IDLE":
-            def _stop():
-                self._session.nav.stopService()
-                self._pausing = False
-                self._eom = False
-                self.fire(log(logging.DEBUG, "Player stopped"), "logger")
-            blockingCallOnMainThread(_stop)
-            self._idle_Timer = Timer(5, Event.create("close_player")) \
-                .register(self)
+            requests.append(("stop",))
+            self._delayed.schedule("close_player", 5,
+                                   Event.create("close_player"))
         if "state" in changed and changed["state"] == "PAUSED":
-            def _pause():
-                pausable = self._pausable()
-                if pausable:
-                    pausable.pause()
-                    self._pausing = True
-                    self.fire(log(logging.DEBUG, "Player paused"), "logger")
-            blockingCallOnMainThread(_pause)
+            requests.append(("pause",))
         if "source" in changed:
-            def _source():
-                try:
-                    print "[CoCy] Creating service reference for " + str(changed["source"])
-                    self._service = eServiceReference(4097, 0, changed["source"])
-                    self._seek_offset = 0
-                    self.fire(log(logging.DEBUG, "Created service %s" 
-                                  % changed["source"]), "logger")
-                    if self._eom:
-                        self._on_play()
-                except Exception as e:
-                    self.fire(log(logging.ERROR, \
-                                  "Failed to set player service to %s: %s"
-                                  % (changed["source"], type(e))), "logger")
-            blockingCallOnMainThread(_source)
+            requests.append(("source", changed["source"]))
+        if "next_source" in changed or "next_source_meta_data" in changed:
+            requests.append(("next", self.next_source,
+                             self.next_source_meta_data))
+        if requests:
+            self._schedule(*requests)
+
+    def _stop(self, stop_service=True):
+        # Called from main thread
+        self._remember_position()
+        self._resume_at = None
+        if stop_service:
+            self._session.nav.stopService()
+        self._position.invalidate()
+        self._seeks.cancel()
+        self._pausing = False
+        self._eom = False
+        self._log(logging.DEBUG, "Player stopped")
+
+    def _pause(self):
+        # Called from main thread
+        pausable = self._pausable()
+        if pausable:
+            pausable.pause()
+            self._position.invalidate()
+            self._pausing = True
+            self._log(logging.DEBUG, "Player paused")
+
+    def _set_source(self, source):
+        # Called from main thread
+        if source == self._switched_to:
+            # Already playing (see _onEOF)
+            self._switched_to = None
+            return
+        self._switched_to = None
+        if source != self._service_uri:
+            self._remember_position()
+        try:
+            self._service = self._service_ref(
+                source, self._media_info(source, self.source_meta_data))
+            self._service_uri = source
+            self._seek_offset = 0
+            self._position.invalidate()
+            self._seeks.cancel()
+            self._log(logging.DEBUG, "Created service %s", source)
+            if self._eom:
+                self._on_play()
+        except Exception as e:
+            self._log(logging.ERROR, "Failed to set player service to %s: %s",
+                      source, type(e))
+
+    def _prepare_next(self, uri, meta_data):
+        # Called from main thread
+        self._next = None
+        if not uri:
+            return
+        media_info = self._media_info(uri, meta_data)
+        if media_info.kind == UNSUPPORTED:
+            self._log(logging.DEBUG, "Cannot prepare next source %s", uri)
+            return
+        service = None
+        if media_info.kind == IMAGE:
+            if self._picDlg is not None and self._picDlg.execing:
+                # Slideshow, have the next picture ready for display
+                self._picDlg.preload(uri, media_info.mimetype)
+        else:
+            service = self._service_ref(uri, media_info)
+            if self._warm_next and not self._proxied(uri, media_info):
+                # Make the media server open (and cache) the stream.
+                # (The proxy requests it when the player opens it,
+                # warming would only add another origin request.)
+                from twisted.web.client import getPage
+                getPage(uri, headers={ "Range": "bytes=0-65535" }) \
+                    .addErrback(lambda failure: None)
+        self._next = _PreparedSource(uri, media_info, service)
+        self._log(logging.DEBUG, "Prepared next source %s", uri)
 
     def _pausable(self):
         # Always called by main thread
@@ -180,50 +544,57 @@ class Enigma2Player(MediaPlayer):
         return None
     
     @handler("play", override=True)
+    @timed("handler.play")
     def _on_play(self):
         if self.source is None:
             return
-        if self._idle_Timer is not None:
-            self._idle_Timer.unregister()
-        def _play():
-            self._maybe_save_old_service()
-            if self._pausing:
-                pausable = self._pausable()
-                if pausable:
-                    pausable.unpause()
-                self._pausing = False
-                print "[CoCy] Resumed Playing..."
-                self.fire(log(logging.DEBUG, "Enigma player unpaused"), "logger")
-                self.fire(player_playing())
-                return
-            # New source
-            from cocy.upnp import DIDL_LITE_NS
-            protocolInfo = self.source_meta_dom.find(
-                str(QName(DIDL_LITE_NS, "item")) + "/" + str(QName(DIDL_LITE_NS, "res"))) \
-                .get("protocolInfo")
-            mimetype = protocolInfo.split(":")[2]
-            if mimetype.startswith("image"):
-                self.fire(log(logging.DEBUG, "Playing picture"), "logger")
-                self.state = "TRANSITIONING"
-                if not self._picDlg.execing:
-                    self._session.execDialog(self._picDlg)
-                def _pic_showing():
-                    self.state = "PLAYING"
-                self._picDlg.loadPicture(self._source, mimetype, _pic_showing)
-                return
-            # Play tune
-            if self._picDlg.execing:
-                self._picDlg.close()
-            self.fire(log(logging.DEBUG, "Starting player (transitioning)"),
-                      "logger")
-            self._eom = False
-            try:
-                self._session.nav.playService(self._service)
-            except Exception as e:
-                self.fire(log(logging.ERROR, "Failed to start playing: %s"
-                    % type(e)), "logger")
+        self._play_requested = monotonic()
+        self._delayed.cancel("close_player")
         self.state = "TRANSITIONING"
-        callOnMainThread(_play)
+        self._schedule(("play",))
+
+    def _play(self, stop_service=False):
+        # Called from main thread
+        self._maybe_save_old_service()
+        if self._pausing:
+            pausable = self._pausable()
+            if pausable:
+                pausable.unpause()
+            self._pausing = False
+            self._log(logging.DEBUG, "Enigma player unpaused")
+            self.fire(player_playing())
+            return
+        # New source
+        media_info = self._media_info(self.source, self.source_meta_data)
+        if media_info.kind == IMAGE:
+            if stop_service:
+                self._session.nav.stopService()
+            self._log(logging.DEBUG, "Playing picture")
+            self.state = "TRANSITIONING"
+            pic_dialog = self._pic_dialog()
+            if not pic_dialog.execing:
+                self._session.execDialog(pic_dialog)
+            def _pic_showing():
+                self._playing()
+                self.state = "PLAYING"
+            pic_dialog.loadPicture(self._source, media_info.mimetype,
+                                   _pic_showing)
+            return
+        if media_info.kind == UNSUPPORTED:
+            self._log(logging.WARNING, "Unsupported media type %s,"
+                      " trying to play anyway", media_info.mimetype)
+        # Play tune
+        if self._picDlg is not None and self._picDlg.execing:
+            self._picDlg.close()
+        self._log(logging.DEBUG, "Starting player (transitioning)")
+        self._eom = False
+        if self._service_uri != self._source:
+            # Played again after the player has been closed
+            self._set_source(self._source)
+        try:
+            self._session.nav.playService(self._service)
+        except Exception as e:
+            self._log(logging.ERROR, "Failed to start playing: %s", type(e))
 
     def _maybe_save_old_service(self):
         # Called from main thread
@@ -251,51 +622,102 @@ class Enigma2Player(MediaPlayer):
         return None
 
     def _duration(self):
+        key = self._service_uri
+        found, duration = self._durations.lookup(key)
+        if found:
+            return duration
         def _get():
-            print "[CoCy] Getting duration..."
             seek = self._seekable()
             if seek is None:
                 return None
             length = seek.getLength()
             if length[0]:
-                return 0
-            print "[CoCy] Duration raw " + str(length[1])
-            print "[CoCy] Duration is " + str(float(length[1]) / 90000)
+                return None
+            self._log(logging.DEBUG, "Duration is %s",
+                      float(length[1]) / 90000)
             return float(length[1]) / 90000
-        return blockingCallOnMainThread(_get)
+        duration = blockingCallOnMainThread(_get)
+        self._durations.store(key, duration)
+        return duration
 
     def current_position(self):
+        pending = self._seeks.pending()
+        if pending is not None:
+            return pending
+        if self.state == "PLAYING" and not self._position.needs_resync():
+            return self._position.position()
+        if self.state == "PLAYING" and self._busy():
+            # Extrapolating a bit longer is better than adding
+            # to the main loop's load
+            position = self._position.position()
+            if position is not None:
+                metrics.count("shed.position")
+                return position
         def _get():
             seek = self._seekable()
             if seek is None:
+                self._position.invalidate()
                 return None
             if self.current_track_duration is None:
                 self.current_track_duration = self._duration()
             pos = seek.getPlayPosition()
             if pos[0]:
                 return 0
-            return self._seek_offset + float(pos[1]) / 90000
+            position = self._seek_offset + float(pos[1]) / 90000
+            self._position.sample(position, self.state == "PLAYING")
+            if self._resume is not None:
+                self._resume.update(self._service_uri, position,
+                                    self.current_track_duration)
+            return position
         return blockingCallOnMainThread(_get)
 
     @handler("seek", override=True)
+    @timed("handler.seek")
     def _on_seek(self, position):
         if self.state != "PLAYING":
             return
-        def _seek():
-            seekable = self._seekable()
-            if seekable is None:
-                return
-            print "[CoCy] Seeking..."
-            self._seek_offset = position
-            seekable.seekTo(long(int(position) * 90000))
-            print "[CoCy] Seeking finished."
-        blockingCallOnMainThread(_seek)
+        # Bursts of seeks (a seek bar being dragged) are coalesced,
+        # only the latest target is actually seeked to.
+        try:
+            self._seeks.request(position, self.current_track_duration)
+        except (TypeError, ValueError):
+            self._log(logging.WARNING, "Invalid seek target %s", position)
+
+    def _seek(self, position):
+        # Called from main thread
+        if self.state != "PLAYING":
+            return
+        self._seek_to(position)
+
+    def _seek_to(self, position):
+        # Called from main thread
+        seekable = self._seekable()
+        if seekable is None:
+            return False
+        self._seek_offset = position
+        seekable.seekTo(long(position * 90000))
+        self._position.reset(position)
+        self._log(logging.DEBUG, "Seeked to %s", position)
+        return True
 
     @handler("set_volume", override=True)
+    @timed("handler.set_volume")
     def _on_set_volume(self, volume):
-        def _set():
-            print "[CoCy] Volume: " + str(volume)
-            self._volctrl.setVolume(int(volume*100), int(volume*100))
-            self.volume = volume
-        blockingCallOnMainThread(_set)
+        # Reads return the requested volume right away, the change
+        # is published when it has been applied (see below).
+        self._volume = volume
+        self._volumes.request(volume)
+
+    def _apply_volume(self, volume):
+        # Called from main thread, at most every volume_interval seconds
+        level = int(round(volume * 100))
+        self._volume_control().setVolume(level, level)
+        self._log(logging.DEBUG, "Volume: %s", volume)
+        self.fire(volume_applied())
+
+    @handler("volume_applied")
+    def _on_volume_applied(self):
+        # Provider updates are thus limited to the rate of the
+        # volume changes actually applied
+        self.volume = self._volumes.target()
     
\ No newline at end of file
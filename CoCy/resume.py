@@ -0,0 +1,214 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from .metrics import metrics
+from .misc import monotonic
+import sqlite3
+import time
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS positions (uri TEXT PRIMARY KEY,"
+    " position REAL NOT NULL, duration REAL, updated REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS positions_updated ON positions (updated)",
+]
+
+class ResumeStore(object):
+    """
+    Remembers the playback positions of sources (by URI), so that
+    playing a source again continues where it has been left.
+
+    Updates are only kept in memory and written to the database at
+    *path* every *flush_interval* seconds (and when the reactor
+    shuts down), all in a single transaction. The database keeps
+    the *max_entries* most recently updated positions.
+
+    Positions before *min_position* seconds or within *end_margin*
+    seconds of the end aren't worth resuming and are removed.
+
+    The database is accessed by a worker thread of its own (so that
+    a slow flash file system doesn't block the main loop) and is
+    only opened when it is first needed.
+
+    Must only be used from the main thread.
+    """
+
+    def __init__(self, path, flush_interval=30, max_entries=500,
+                 min_position=10, end_margin=10, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._path = path
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.min_position = min_position
+        self.end_margin = end_margin
+        # A single thread, the connection is used by this thread only
+        self._pool = ThreadPool(1, 1, "ResumeStore")
+        self._db = None
+        self._loop = None
+        self._trigger = None
+        # Pending changes, uri -> (position, duration, updated), a
+        # position of None removes the entry
+        self._pending = dict()
+
+    def start(self):
+        if self._loop is not None:
+            return
+        self._pool.start()
+        self._loop = LoopingCall(self.flush)
+        self._loop.clock = self._reactor
+        self._loop.start(self.flush_interval, now=False)
+        self._trigger = self._reactor.addSystemEventTrigger(
+            "before", "shutdown", self._on_shutdown)
+
+    @property
+    def running(self):
+        return self._loop is not None
+
+    def _run(self, func, *args):
+        return deferToThreadPool(self._reactor, self._pool, func, *args)
+
+    def _connection(self):
+        # Called from the worker thread
+        if self._db is None:
+            db = sqlite3.connect(self._path)
+            for statement in SCHEMA:
+                db.execute(statement)
+            db.commit()
+            self._db = db
+        return self._db
+
+    def update(self, uri, position, duration=None):
+        """
+        Record *position* (in seconds) for *uri*.
+        """
+        if not uri or position is None:
+            return
+        if position < self.min_position or (duration and
+                position > duration - self.end_margin):
+            self.forget(uri)
+            return
+        self._pending[uri] = (position, duration, time.time())
+
+    def forget(self, uri):
+        """
+        Remove the position of *uri* (e.g. because it has been
+        played to the end).
+        """
+        if uri:
+            self._pending[uri] = (None, None, time.time())
+
+    def lookup(self, uri):
+        """
+        Returns a deferred that fires with the position recorded
+        for *uri* or ``None``.
+        """
+        if uri in self._pending:
+            return defer.succeed(self._pending[uri][0])
+        if not self.running:
+            return defer.succeed(None)
+        def _failed(failure):
+            failure.trap(sqlite3.Error)
+            print "[CoCy] Cannot read resume position: %s" \
+                % failure.getErrorMessage()
+            return None
+        return self._run(self._read, uri).addErrback(_failed)
+
+    def _read(self, uri):
+        # Called from the worker thread
+        row = self._connection().execute(
+            "SELECT position FROM positions WHERE uri = ?",
+            (uri,)).fetchone()
+        return row[0] if row else None
+
+    def flush(self):
+        """
+        Write the pending changes to the database. Returns a deferred
+        that fires when they have been written.
+        """
+        if not self.running or not self._pending:
+            return defer.succeed(None)
+        started = monotonic()
+        pending = self._pending
+        self._pending = dict()
+        def _written(_):
+            metrics.count("resume.flushes")
+            metrics.observe("resume.flush", monotonic() - started)
+        def _failed(failure):
+            failure.trap(sqlite3.Error)
+            print "[CoCy] Cannot save resume positions: %s" \
+                % failure.getErrorMessage()
+            # Try again with the next flush, keeping newer updates
+            pending.update(self._pending)
+            self._pending = pending
+        return self._run(self._write, pending) \
+            .addCallbacks(_written, _failed)
+
+    def _write(self, pending):
+        # Called from the worker thread
+        db = self._connection()
+        with db:
+            db.executemany(
+                "DELETE FROM positions WHERE uri = ?",
+                [(uri,) for uri, entry in pending.items() if entry[0] is None])
+            db.executemany(
+                "INSERT OR REPLACE INTO positions"
+                " (uri, position, duration, updated) VALUES (?, ?, ?, ?)",
+                [(uri,) + entry for uri, entry in pending.items()
+                 if entry[0] is not None])
+            # Keep the most recently used entries only
+            db.execute(
+                "DELETE FROM positions WHERE uri NOT IN (SELECT uri"
+                " FROM positions ORDER BY updated DESC LIMIT ?)",
+                (self.max_entries,))
+
+    def _disconnect(self):
+        # Called from the worker thread
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _on_shutdown(self):
+        self._trigger = None
+        return self.close()
+
+    def close(self):
+        """
+        Write the pending changes and close the database. Returns a
+        deferred (the reactor's shutdown waits for it).
+        """
+        if not self.running:
+            return defer.succeed(None)
+        if self._loop.running:
+            self._loop.stop()
+        if self._trigger is not None:
+            self._reactor.removeSystemEventTrigger(self._trigger)
+            self._trigger = None
+        d = self.flush()
+        d.addCallback(lambda _: self._run(self._disconnect))
+        def _stopped(result):
+            self._loop = None
+            self._pool.stop()
+            return result
+        return d.addBoth(_stopped)
@@ -0,0 +1,129 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from threading import Lock
+from .misc import monotonic
+
+class SeekScheduler(object):
+    """
+    Coalesces seek requests. A request doesn't seek immediately but
+    waits *delay* seconds for further requests, only the most recent
+    target is then passed to *seek* (on the main thread). While
+    requests keep arriving (a seek bar being dragged), a seek is
+    executed at least every *max_delay* seconds.
+
+    Requests may come from any thread, *seek* is invoked by the
+    reactor (see :class:`~.ebrigde.MainThreadBridge`).
+    """
+
+    def __init__(self, seek, delay=0.15, max_delay=0.5, bridge=None,
+                 metrics=None, clock=monotonic):
+        self._seek = seek
+        self.delay = delay
+        self.max_delay = max_delay
+        if bridge is None:
+            from .ebrigde import mainThreadBridge
+            bridge = mainThreadBridge()
+        self._bridge = bridge
+        self._metrics = metrics
+        self._clock = clock
+        self._lock = Lock()
+        self._target = None
+        self._first = None
+        self._deadline = None
+        self._armed = False
+        self.requests = 0
+        self.executed = 0
+
+    def pending(self):
+        """
+        The target of the seek that is still to be executed or ``None``.
+        """
+        return self._target
+
+    def request(self, target, duration=None):
+        """
+        Request a seek to *target* seconds. The target is limited to
+        *duration* (if known). Returns the effective target.
+
+        cocy's AVTransport Seek converts the REL_TIME/ABS_TIME argument
+        to seconds (``duration_to_secs``) before firing the ``seek``
+        event, so no parsing of time strings is needed here. Raises
+        ``ValueError`` if *target* isn't a number.
+        """
+        seconds = float(target)
+        if duration:
+            seconds = min(seconds, duration)
+        seconds = max(seconds, 0.0)
+        now = self._clock()
+        with self._lock:
+            if self._target is None:
+                self._first = now
+            self._target = seconds
+            self._deadline = min(now + self.delay,
+                                 self._first + self.max_delay)
+            self.requests += 1
+            arm = not self._armed
+            self._armed = True
+        self._count("seek.requests")
+        if arm:
+            self._bridge.call(self._arm)
+        return seconds
+
+    def cancel(self):
+        """
+        Discard the pending seek (if any).
+        """
+        with self._lock:
+            self._target = None
+
+    def _count(self, name):
+        if self._metrics is not None:
+            self._metrics.count(name)
+
+    def _arm(self):
+        # Called from main thread
+        with self._lock:
+            deadline = self._deadline
+        self._bridge.reactor.callLater(max(deadline - self._clock(), 0),
+                                       self._fire)
+
+    def _fire(self):
+        # Called from main thread
+        with self._lock:
+            if self._target is not None and self._clock() < self._deadline:
+                # Deadline has been moved by a later request
+                remaining = self._deadline - self._clock()
+            else:
+                remaining = None
+                target = self._target
+                first = self._first
+                self._target = None
+                self._armed = False
+        if remaining is not None:
+            self._bridge.reactor.callLater(remaining, self._fire)
+            return
+        if target is None:
+            return
+        self.executed += 1
+        self._count("seek.executed")
+        if self._metrics is not None:
+            self._metrics.observe("seek.delay", self._clock() - first)
+        self._seek(target)
@@ -19,8 +19,16 @@
 .. codeauthor:: mnl
 """
 from circuits_bricks.app import Application
+from circuits_bricks.app.logger import log
+from circuits.core.components import BaseComponent
+from circuits.core.handlers import handler
 from cocy.upnp.device_server import UPnPDeviceServer
 from renderer import Enigma2Player
+from logbuffer import buffer_handlers
+from metrics import metrics, tree_gauges
+from misc import monotonic
+import logging
+import os
 
 CONFIG = {
     "logging": {
@@ -28,31 +36,146 @@ CONFIG = {
         "file": "/var/log/cocy.log",
         "when": "midnight",
         "backupCount": 7,
-        "level": "DEBUG",
+        # Use DEBUG for detailed information about the player's events
+        "level": "INFO",
+        # Seconds between writes of buffered log records
+        "flush_interval": "2",
+        # Number of recent records kept in memory
+        "recent": "200",
+    },
+    "mainloop": {
+        # Seconds between heartbeats that measure the main loop's lag
+        "heartbeat": "0.5",
+        # Lag (seconds) above which non-critical work is skipped
+        "busy_lag": "0.25",
     },
     "ui": {
         "port": "8123",
     },
+    "renderer": {
+        # Seconds between position reads from the player while playing
+        "position_resync": "5",
+        # Request the start of the next track before it is played
+        "warm_next": "False",
+        # Seconds to wait for further seeks before seeking (seek bar dragging)
+        "seek_delay": "0.15",
+        # Minimum seconds between volume changes applied to the hardware
+        "volume_interval": "0.1",
+        # Seconds for ramping the volume from 0 to 100% (0 disables ramping)
+        "volume_ramp": "0",
+        # Number of next pictures decoded in advance during slideshows
+        "picture_preload": "1",
+        # Downscale large pictures to the screen size in a worker process
+        # before decoding them (requires the python imaging library)
+        "picture_downscale": "False",
+        # Megabytes read ahead by a local proxy for played streams
+        # (0 lets the player access the media server directly)
+        "stream_buffer": "0",
+        # Continue sources that are played again where they have been left
+        "resume": "True",
+        # Seconds between writes of changed resume positions
+        "resume_flush_interval": "30",
+    },
+    "debug": {
+        # Print the component graph on startup
+        "graph": "False",
+    },
 }
 
 
+class StartupMonitor(BaseComponent):
+    """
+    Records the durations of the startup phases and logs them, together
+    with the time until the application has started (and the device
+    is therefore being advertised).
+    """
+
+    def __init__(self):
+        super(StartupMonitor, self).__init__()
+        self._started_at = monotonic()
+        self._phase_started_at = self._started_at
+        self._phases = []
+
+    def phase(self, name):
+        """
+        Mark the end of the phase *name*, the next phase starts.
+        """
+        now = monotonic()
+        metrics.observe("startup." + name, now - self._phase_started_at)
+        self._phases.append("%s: %.3f s" % (name, now - self._phase_started_at))
+        self._phase_started_at = now
+
+    @handler("started", channel="application")
+    def _on_started(self, component):
+        elapsed = monotonic() - self._started_at
+        metrics.observe("startup.discoverable", elapsed)
+        self.fire(log(logging.INFO, "Discoverable after %.3f s (%s)"
+                      % (elapsed, ", ".join(self._phases))), "logger")
+
+
 def start(session):
+    monitor = StartupMonitor()
     application = Application("CoCy", CONFIG, 
                               { "config_dir": "/etc/cocy",
                                 "app_dir": "/var/lib/cocy" })
+    config = application.config
+    # Write the log from a background thread, the flash may be slow
+    buffer_handlers(
+        flush_interval=float(config.get("logging", "flush_interval", 2)),
+        capacity=int(config.get("logging", "recent", 200)))
+    monitor.register(application)
+    monitor.phase("application")
     # Debugger().register(application)
-#    # Build a web (HTTP) server for handling user interface requests.
-#    port = int(application.config.get("ui", "port", 0))
-#    portal_server = BaseServer(("", port), channel="ui").register(application)
-#    Portal(portal_server, title="Test Portal").register(application)
-#    HelloWorldPortlet().register(application)
-    
-    # The server    
+
+    # The server, to be advertised as soon as possible. Everything else
+    # (including the player's dialog) is created when needed.
     UPnPDeviceServer(application.app_dir).register(application)
-    player = Enigma2Player(session)
+    # Tells a busy main loop from one that is gone
+    from watchdog import MainLoopWatchdog
+    from ebrigde import mainThreadBridge
+    watchdog = MainLoopWatchdog(
+        interval=float(config.get("mainloop", "heartbeat", 0.5)),
+        busy_lag=float(config.get("mainloop", "busy_lag", 0.25)))
+    watchdog.start()
+    mainThreadBridge().watchdog = watchdog
+    resume = None
+    if config.get("renderer", "resume", "True") == "True":
+        from resume import ResumeStore
+        resume = ResumeStore(os.path.join(application.app_dir, "resume.db"),
+            flush_interval=float(config.get("renderer",
+                                            "resume_flush_interval", 30)))
+    player = Enigma2Player(session, position_resync=float(
+        config.get("renderer", "position_resync", 5)),
+        warm_next=config.get("renderer", "warm_next", "False") == "True",
+        seek_delay=float(config.get("renderer", "seek_delay", 0.15)),
+        volume_interval=float(config.get("renderer", "volume_interval", 0.1)),
+        volume_ramp=float(config.get("renderer", "volume_ramp", 0)),
+        picture_preload=int(config.get("renderer", "picture_preload", 1)),
+        picture_downscale=config.get("renderer", "picture_downscale",
+                                     "False") == "True",
+        stream_buffer=int(float(config.get("renderer", "stream_buffer", 0))
+                          * 1024 * 1024),
+        resume=resume, watchdog=watchdog)
     print "[CoCy] Player: " + str(player)
     player.register(application)
-    
-    from circuits.tools import graph
-    print graph(application)
+    tree_gauges(application)
+    monitor.phase("device")
     application.start()
+    monitor.phase("start")
+    if resume is not None:
+        # Not needed before a control point has found the renderer
+        resume.start()
+
+    # Build a web (HTTP) server for handling user interface requests,
+    # currently the metrics only.
+    port = int(config.get("ui", "port", 0))
+    if port:
+        from circuits.web import Server
+        from metricsui import MetricsController
+        ui_server = Server(("", port), channel="ui").register(application)
+        MetricsController().register(ui_server)
+        monitor.phase("ui")
+
+    if config.get("debug", "graph", "False") == "True":
+        from circuits.tools import graph
+        print graph(application)
@@ -0,0 +1,327 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from collections import deque, OrderedDict
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from .metrics import metrics
+from .misc import monotonic
+
+REQUEST_HEADERS = ["range", "user-agent", "transfermode.dlna.org",
+                   "getcontentfeatures.dlna.org", "timeseekrange.dlna.org"]
+"""Headers of the player's request that are passed to the origin."""
+
+RESPONSE_HEADERS = ["content-type", "content-length", "content-range",
+                    "accept-ranges", "contentfeatures.dlna.org",
+                    "transfermode.dlna.org", "timeseekrange.dlna.org"]
+"""Headers of the origin's response that are passed to the player."""
+
+class ReadAheadBuffer(object):
+    """
+    A FIFO of byte strings with a capacity in bytes. Data is
+    kept as received (no copying) until it is read.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._chunks = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def free(self):
+        return self.capacity - self._size
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+
+    def read(self, size):
+        """
+        Return up to *size* bytes (at least one chunk).
+        """
+        chunk = self._chunks.popleft()
+        if len(chunk) > size:
+            self._chunks.appendleft(chunk[size:])
+            chunk = chunk[:size]
+        self._size -= len(chunk)
+        return chunk
+
+
+class _Origin(Protocol):
+    # Receives the origin's response body
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def dataReceived(self, data):
+        self._stream.received(data)
+
+    def connectionLost(self, reason):
+        self._stream.origin_done(reason)
+
+
+class _Stream(object):
+    """
+    A player's request that is being served from the origin. Data
+    from the origin is read into the buffer as fast as the origin
+    provides it (until the buffer is full), the player gets it as
+    fast as it consumes it.
+    """
+
+    def __init__(self, proxy, request, origin):
+        self._proxy = proxy
+        self._request = request
+        self._origin_url = origin
+        self.buffer = ReadAheadBuffer(proxy.buffer_size)
+        self._response_pending = None
+        self._origin = None
+        self._origin_paused = False
+        self._origin_done = False
+        self._client_paused = False
+        self._finished = False
+        self._producing = False
+        self._primed = False
+        self.started = monotonic()
+        self.ended = None
+        self.received_bytes = 0
+        self.sent_bytes = 0
+        self.underruns = 0
+
+    def start(self):
+        headers = Headers()
+        for name in REQUEST_HEADERS:
+            value = self._request.getHeader(name)
+            if value is not None:
+                headers.addRawHeader(name, value)
+        self._request.notifyFinish().addBoth(self._client_gone)
+        d = self._proxy.agent.request(self._request.method,
+                                      self._origin_url, headers)
+        self._response_pending = d
+        d.addCallbacks(self._response, self._failed)
+
+    def _response(self, response):
+        self._response_pending = None
+        if self._finished:
+            return
+        request = self._request
+        request.setResponseCode(response.code, response.phrase)
+        for name in RESPONSE_HEADERS:
+            values = response.headers.getRawHeaders(name)
+            if values:
+                request.setHeader(name, values[-1])
+        if request.method == "HEAD" or response.length == 0:
+            self._finish()
+            return
+        request.registerProducer(self, True)
+        self._producing = True
+        self._origin = _Origin(self)
+        response.deliverBody(self._origin)
+
+    def _failed(self, failure):
+        self._response_pending = None
+        if self._finished:
+            return
+        self._request.setResponseCode(502)
+        self._finish()
+
+    def received(self, data):
+        self.received_bytes += len(data)
+        self.buffer.write(data)
+        if self.buffer.free <= 0 and not self._origin_paused:
+            self._origin_paused = True
+            self._origin.transport.pauseProducing()
+        self._flush()
+
+    def origin_done(self, reason):
+        self._origin_done = True
+        self.ended = monotonic()
+        self._flush()
+
+    def _flush(self):
+        while not self._client_paused and not self._finished \
+                and len(self.buffer):
+            data = self.buffer.read(self._proxy.chunk_size)
+            self.sent_bytes += len(data)
+            self._request.write(data)
+        if len(self.buffer) >= self._proxy.chunk_size:
+            self._primed = True
+        if self._origin_paused \
+                and len(self.buffer) <= self.buffer.capacity / 2:
+            self._origin_paused = False
+            self._origin.transport.resumeProducing()
+        if len(self.buffer) == 0:
+            if self._origin_done:
+                self._finish()
+            elif self._primed and not self._client_paused:
+                # Read ahead data has been used up
+                self._primed = False
+                self.underruns += 1
+                metrics.count("proxy.underruns")
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        if self._producing:
+            self._request.unregisterProducer()
+        self._request.finish()
+        self._proxy.stream_done(self)
+
+    def _client_gone(self, result):
+        # Player has closed the connection (e.g. when seeking)
+        if self._finished:
+            return
+        self._finished = True
+        if self._response_pending is not None:
+            self._response_pending.cancel()
+        if self._origin is not None and not self._origin_done:
+            self._origin.transport.stopProducing()
+        self._proxy.stream_done(self)
+
+    # Producer interface, invoked by the connection to the player
+
+    def pauseProducing(self):
+        self._client_paused = True
+
+    def resumeProducing(self):
+        self._client_paused = False
+        self._flush()
+
+    def stopProducing(self):
+        self._client_gone(None)
+
+    @property
+    def throughput(self):
+        """
+        Bytes per second received from the origin.
+        """
+        elapsed = (self.ended or monotonic()) - self.started
+        return self.received_bytes / elapsed if elapsed > 0 else 0
+
+
+class _ProxyResource(Resource):
+    isLeaf = True
+
+    def __init__(self, proxy):
+        Resource.__init__(self)
+        self._proxy = proxy
+
+    def render_GET(self, request):
+        origin = self._proxy.origin(request.postpath[-1])
+        if origin is None:
+            request.setResponseCode(404)
+            return ""
+        self._proxy.stream(request, origin).start()
+        return NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+
+class StreamProxy(object):
+    """
+    A local HTTP proxy that reads ahead from the origin server into
+    a buffer of *buffer_size* bytes (for each stream), so that short
+    stalls of the network or the media server don't interrupt
+    playback. The player is given the URL returned by
+    :meth:`url_for`. Range requests are passed through to the origin.
+
+    Buffer fill, throughput and underruns of the most recent
+    stream are available as metrics (``proxy.*``).
+
+    Must only be used from the main thread.
+    """
+
+    def __init__(self, buffer_size=8*1024*1024, chunk_size=64*1024,
+                 port=0, max_urls=8, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self._port_number = port
+        self.max_urls = max_urls
+        self.agent = Agent(reactor, connectTimeout=10)
+        self._port = None
+        self._urls = OrderedDict()
+        self._next_id = 0
+        self.streams = []
+        self.last_stream = None
+        metrics.gauge("proxy.buffer_fill", self._fill)
+        metrics.gauge("proxy.throughput", self._throughput)
+
+    def start(self):
+        if self._port is None:
+            self._port = self._reactor.listenTCP(
+                self._port_number, Site(_ProxyResource(self)),
+                interface="127.0.0.1")
+
+    def stop(self):
+        if self._port is not None:
+            self._port.stopListening()
+            self._port = None
+
+    def url_for(self, origin):
+        """
+        Returns the local URL that serves *origin*.
+        """
+        self.start()
+        for key, url in self._urls.items():
+            if url == origin:
+                return self._local_url(key)
+        key = str(self._next_id)
+        self._next_id += 1
+        self._urls[key] = origin
+        while len(self._urls) > self.max_urls:
+            self._urls.popitem(last=False)
+        return self._local_url(key)
+
+    def _local_url(self, key):
+        return "http://127.0.0.1:%d/stream/%s" \
+            % (self._port.getHost().port, key)
+
+    def origin(self, key):
+        return self._urls.get(key)
+
+    def stream(self, request, origin):
+        stream = _Stream(self, request, origin)
+        self.streams.append(stream)
+        self.last_stream = stream
+        metrics.count("proxy.streams")
+        return stream
+
+    def stream_done(self, stream):
+        if stream in self.streams:
+            self.streams.remove(stream)
+
+    def _fill(self):
+        stream = self.last_stream
+        if stream is None:
+            return None
+        return float(len(stream.buffer)) / stream.buffer.capacity
+
+    def _throughput(self):
+        stream = self.last_stream
+        return None if stream is None else stream.throughput
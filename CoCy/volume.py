@@ -0,0 +1,115 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from threading import Lock
+from .misc import monotonic
+
+class VolumeScheduler(object):
+    """
+    Applies volume changes asynchronously. Requests only record the
+    target level, *apply* (invoked on the main thread with a level
+    between 0 and 1) is called at most every *interval* seconds with
+    the latest target.
+
+    If *ramp* is set, the level changes by at most ``interval / ramp``
+    per invocation, i.e. a change from 0 to 1 takes *ramp* seconds.
+    The steps are made by a single task that follows the target,
+    further requests only update the target. Ramps start from the
+    level returned by *current* (invoked on the main thread before
+    the first step), if given.
+    """
+
+    def __init__(self, apply, interval=0.1, ramp=0, current=None,
+                 bridge=None, metrics=None, clock=monotonic):
+        self._apply = apply
+        self._current = current
+        self.interval = interval
+        self.ramp = ramp
+        if bridge is None:
+            from .ebrigde import mainThreadBridge
+            bridge = mainThreadBridge()
+        self._bridge = bridge
+        self._metrics = metrics
+        self._clock = clock
+        self._lock = Lock()
+        self._target = None
+        self._level = None
+        self._applied_at = None
+        self._armed = False
+        self.requests = 0
+        self.applied = 0
+
+    def target(self):
+        """
+        The most recently requested level (or ``None``).
+        """
+        return self._target
+
+    def request(self, volume):
+        """
+        Request *volume* to be applied.
+        """
+        with self._lock:
+            self._target = volume
+            self.requests += 1
+            arm = not self._armed
+            self._armed = True
+        if self._metrics is not None:
+            self._metrics.count("volume.requests")
+        if arm:
+            self._bridge.call(self._arm)
+
+    def _arm(self):
+        # Called from main thread
+        delay = 0
+        if self._applied_at is not None:
+            delay = max(self._applied_at + self.interval - self._clock(), 0)
+        self._bridge.reactor.callLater(delay, self._step)
+
+    def _next_level(self, target):
+        if not self.ramp or self._level is None:
+            return target
+        delta = self.interval / float(self.ramp)
+        if abs(target - self._level) <= delta:
+            return target
+        if target > self._level:
+            return self._level + delta
+        return self._level - delta
+
+    def _step(self):
+        # Called from main thread
+        with self._lock:
+            target = self._target
+        if self._level is None and self._current is not None:
+            self._level = self._current()
+        level = self._next_level(target)
+        if level != self._level:
+            self._level = level
+            self._applied_at = self._clock()
+            self.applied += 1
+            if self._metrics is not None:
+                self._metrics.count("volume.applied")
+            self._apply(level)
+        with self._lock:
+            if self._level == self._target:
+                self._armed = False
+                return
+        # Ramping or target changed while applying
+        self._bridge.reactor.callLater(self.interval, self._step)
@@ -0,0 +1,135 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+"""
+from collections import deque
+from .metrics import metrics
+from .misc import monotonic
+
+class MainLoopWatchdog(object):
+    """
+    Measures how late the main loop (the twisted reactor) runs a call
+    scheduled every *interval* seconds. The lag of the most recent
+    *window* heartbeats is kept for percentiles, all lags are recorded
+    as ``mainloop.lag`` metric.
+
+    The main loop is considered busy while the 90th percentile of the
+    recent lags or the time since the overdue heartbeat exceeds
+    *busy_lag* seconds. Non-critical work may be skipped then.
+
+    The time that other threads wait for the main loop (see
+    :meth:`timeout`) adapts to the stalls observed so far. A shutdown
+    of the reactor is detected by a "before shutdown" trigger, so
+    that waiting for it can be abandoned immediately.
+
+    :meth:`start` and :meth:`stop` must be invoked on the main thread,
+    the other methods may be used from any thread.
+    """
+
+    def __init__(self, interval=0.5, window=60, busy_lag=0.25,
+                 min_timeout=30.0, max_timeout=300.0, reactor=None,
+                 clock=monotonic):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._clock = clock
+        self.interval = interval
+        self.busy_lag = busy_lag
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._lags = deque(maxlen=window)
+        self._due = None
+        self._call = None
+        self._trigger = None
+        self.shutting_down = False
+        for p in (50, 90, 99):
+            metrics.gauge("mainloop.lag.p%d" % p,
+                          lambda p=p: self.percentile(p))
+        metrics.gauge("mainloop.stalled", self.stalled)
+
+    def start(self):
+        if self._call is not None:
+            return
+        self._trigger = self._reactor.addSystemEventTrigger(
+            "before", "shutdown", self._on_shutdown)
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._due = None
+        if self._trigger is not None:
+            self._reactor.removeSystemEventTrigger(self._trigger)
+            self._trigger = None
+
+    @property
+    def running(self):
+        return self._due is not None
+
+    def _schedule(self):
+        self._due = self._clock() + self.interval
+        self._call = self._reactor.callLater(self.interval, self._beat)
+
+    def _beat(self):
+        lag = max(0.0, self._clock() - self._due)
+        self._lags.append(lag)
+        metrics.observe("mainloop.lag", lag)
+        self._schedule()
+
+    def _on_shutdown(self):
+        self.shutting_down = True
+        self._trigger = None
+        self.stop()
+
+    def stalled(self):
+        """
+        Seconds since the next heartbeat has become due (0 if it
+        isn't overdue or the watchdog isn't running).
+        """
+        due = self._due
+        if due is None:
+            return 0.0
+        return max(0.0, self._clock() - due)
+
+    def percentile(self, p):
+        """
+        The *p*-th percentile of the recent lags (``None`` if no
+        heartbeat has been measured yet).
+        """
+        lags = sorted(list(self._lags))
+        if not lags:
+            return None
+        return lags[min(len(lags) - 1, int(p / 100.0 * len(lags)))]
+
+    def busy(self):
+        """
+        Whether the main loop is saturated.
+        """
+        return self.stalled() > self.busy_lag \
+            or (self.percentile(90) or 0) > self.busy_lag
+
+    def timeout(self):
+        """
+        How long the main loop may be unresponsive before it is
+        considered dead: four times the longest recent lag, at least
+        *min_timeout* and at most *max_timeout* seconds.
+        """
+        worst = max(list(self._lags) or [0])
+        return min(self.max_timeout, max(self.min_timeout, 4 * worst))
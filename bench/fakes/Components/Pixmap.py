@@ -0,0 +1,42 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+
+Stand-in for Enigma2's Pixmap widget.
+"""
+from enigma import eSize
+
+class _Instance(object):
+
+    def __init__(self):
+        self.pixmap = None
+        self.updates = 0
+
+    def size(self):
+        return eSize(1280, 720)
+
+    def setPixmap(self, pixmap):
+        self.pixmap = pixmap
+        self.updates += 1
+
+
+class Pixmap(object):
+
+    def __init__(self):
+        self.instance = _Instance()
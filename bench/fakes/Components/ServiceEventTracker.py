@@ -0,0 +1,35 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+
+Stand-in for Enigma2's ServiceEventTracker. Instead of listening to
+the navigation's events, the tracker registers its event map with
+the fake navigation of the screen's session.
+"""
+
+class ServiceEventTracker(object):
+
+    def __init__(self, screen, eventmap):
+        self._eventmap = eventmap
+        screen.session.nav.addTracker(self)
+
+    def handle(self, event):
+        callback = self._eventmap.get(event)
+        if callback is not None:
+            callback()
@@ -0,0 +1,36 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+
+Stand-in for Enigma2's Screen.
+"""
+
+class Screen(dict):
+
+    def __init__(self, session):
+        dict.__init__(self)
+        self.session = session
+        self.execing = False
+        self.onClose = []
+        self.onLayoutFinish = []
+
+    def close(self, *args):
+        self.execing = False
+        for callback in self.onClose:
+            callback()
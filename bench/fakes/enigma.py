@@ -0,0 +1,185 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+
+Stand-ins for the parts of Enigma2's ``enigma`` module used by CoCy.
+Latencies (in seconds) are taken from :data:`LATENCIES` and simulate
+a box whose main loop is blocked while the call is executed.
+"""
+import time
+from twisted.internet import reactor
+
+LATENCIES = {
+    "call": 0.0,       # any navigation/service call
+    "start": 0.2,      # from playService to evStart
+    "seek": 0.05,      # a seekTo in the demuxer
+    "volume": 0.005,   # setting the volume
+    "decode": 0.1,     # decoding a picture
+}
+
+STATS = dict()
+"""Number of calls, by name."""
+
+def simulate(name, latency="call"):
+    STATS[name] = STATS.get(name, 0) + 1
+    delay = LATENCIES.get(latency, 0)
+    if delay:
+        time.sleep(delay)
+
+
+class iPlayableService(object):
+    evStart = 1
+    evEnd = 2
+    evTunedIn = 3
+    evTuneFailed = 4
+    evEOF = 5
+    evSOF = 6
+    evUpdatedEventInfo = 7
+    evUpdatedInfo = 8
+    evSeekableStatusChanged = 9
+    evBuffering = 10
+
+
+class eServiceReference(object):
+
+    def __init__(self, type, flags, path):
+        self.type = type
+        self.flags = flags
+        self.path = path
+
+    def getPath(self):
+        return self.path
+
+    def getName(self):
+        return self.path
+
+    def __repr__(self):
+        return "<eServiceReference %s:%s:%s>" \
+            % (self.type, self.flags, self.path)
+
+
+class eDVBVolumecontrol(object):
+
+    _instance = None
+
+    def __init__(self):
+        self._volume = 50
+
+    @classmethod
+    def getInstance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def getVolume(self):
+        return self._volume
+
+    def setVolume(self, left, right):
+        simulate("setVolume", "volume")
+        self._volume = left
+
+
+class eSize(object):
+
+    def __init__(self, width, height):
+        self._width = width
+        self._height = height
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+
+class _Desktop(object):
+
+    def size(self):
+        return eSize(1280, 720)
+
+def getDesktop(screen):
+    return _Desktop()
+
+
+class _Signal(object):
+
+    def __init__(self):
+        self._callbacks = []
+
+    def get(self):
+        return self._callbacks
+
+
+class ePicLoad(object):
+    """
+    Decodes asynchronously: the result is delivered after the
+    "decode" latency without blocking the main loop. Like the real
+    decoder, a decode is refused (returns 1) while another one is
+    in progress.
+    """
+
+    def __init__(self):
+        self.PictureData = _Signal()
+        self._data = None
+        self._busy = False
+
+    def setPara(self, para):
+        self._para = para
+
+    def startDecode(self, path):
+        if self._busy:
+            STATS["decodeRefused"] = STATS.get("decodeRefused", 0) + 1
+            return 1
+        STATS["startDecode"] = STATS.get("startDecode", 0) + 1
+        self._busy = True
+        def _decoded():
+            self._busy = False
+            self._data = ("pixmap", path)
+            for callback in self.PictureData.get():
+                callback("")
+        reactor.callLater(LATENCIES.get("decode", 0), _decoded)
+        return 0
+
+    def getData(self):
+        return self._data
+
+
+class eTimer(object):
+
+    def __init__(self):
+        self.callback = []
+        self._call = None
+
+    def start(self, msecs, single_shot=False):
+        self.stop()
+        def _fire():
+            self._call = None
+            for callback in self.callback:
+                callback()
+            if not single_shot:
+                self.start(msecs, single_shot)
+        self._call = reactor.callLater(msecs / 1000.0, _fire)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def isActive(self):
+        return self._call is not None
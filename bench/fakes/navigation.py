@@ -0,0 +1,183 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+
+A fake Enigma2 session with a navigation that "plays" services by
+advancing a clock. Service events are delivered to the registered
+(fake) service event trackers on the reactor thread.
+"""
+import time
+from twisted.internet import reactor
+from enigma import iPlayableService, LATENCIES, simulate
+
+class FakeSeek(object):
+
+    def __init__(self, service):
+        self._service = service
+
+    def isCurrentlySeekable(self):
+        simulate("isCurrentlySeekable")
+        return self._service.duration is not None
+
+    def getLength(self):
+        simulate("getLength")
+        if self._service.duration is None:
+            return (-1, 0)
+        return (0, long(self._service.duration * 90000))
+
+    def getPlayPosition(self):
+        simulate("getPlayPosition")
+        # Like servicemp3 with HTTP sources, relative to the last seek
+        return (0, long((self._service.position() - self._service.seeked_to)
+                        * 90000))
+
+    def seekTo(self, pts):
+        simulate("seekTo", "seek")
+        self._service.seek_to(pts / 90000.0)
+
+
+class FakePausable(object):
+
+    def __init__(self, service):
+        self._service = service
+
+    def pause(self):
+        simulate("pause")
+        self._service.set_paused(True)
+
+    def unpause(self):
+        simulate("unpause")
+        self._service.set_paused(False)
+
+
+class FakeService(object):
+
+    def __init__(self, ref, duration):
+        self.ref = ref
+        self.duration = duration
+        self._offset = 0.0
+        self.seeked_to = 0.0
+        self._started = None
+        self._paused = False
+
+    def start(self):
+        self._started = time.time()
+
+    def position(self):
+        if self._started is None:
+            return 0.0
+        if self._paused:
+            return self._offset
+        return self._offset + time.time() - self._started
+
+    def set_paused(self, paused):
+        self._offset = self.position()
+        self._started = time.time()
+        self._paused = paused
+
+    def seek_to(self, position):
+        self._offset = position
+        self.seeked_to = position
+        self._started = time.time()
+
+    def seek(self):
+        return FakeSeek(self)
+
+    def pause(self):
+        return FakePausable(self)
+
+
+class FakeNavigation(object):
+    """
+    Plays services with the given *duration* (``None`` for
+    streams without known length). Every service reaches
+    its end after *duration* seconds if *auto_eof* is set.
+    """
+
+    def __init__(self, duration=600.0, auto_eof=False):
+        self.duration = duration
+        self.auto_eof = auto_eof
+        self._trackers = []
+        self._service = None
+        self._pending = []
+        self.played = []
+
+    def addTracker(self, tracker):
+        self._trackers.append(tracker)
+
+    def emit(self, event):
+        for tracker in self._trackers:
+            tracker.handle(event)
+
+    def _later(self, delay, func, *args):
+        call = reactor.callLater(delay, func, *args)
+        self._pending.append(call)
+
+    def _cancel_pending(self):
+        for call in self._pending:
+            if call.active():
+                call.cancel()
+        self._pending = []
+
+    def playService(self, ref):
+        simulate("playService")
+        self._cancel_pending()
+        service = FakeService(ref, self.duration)
+        self._service = service
+        self.played.append((time.time(), ref))
+        def _started():
+            if self._service is not service:
+                return
+            service.start()
+            self.emit(iPlayableService.evStart)
+            self.emit(iPlayableService.evUpdatedInfo)
+            if self.auto_eof and service.duration is not None:
+                self._later(service.duration, _eof)
+        def _eof():
+            if self._service is service:
+                self.emit(iPlayableService.evEOF)
+        self._later(LATENCIES.get("start", 0), _started)
+        return 0
+
+    def stopService(self):
+        simulate("stopService")
+        self._cancel_pending()
+        self._service = None
+
+    def getCurrentService(self):
+        simulate("getCurrentService")
+        return self._service
+
+    def getCurrentlyPlayingServiceOrGroup(self):
+        return None if self._service is None else self._service.ref
+
+
+class FakeSession(object):
+
+    def __init__(self, nav=None):
+        self.nav = nav if nav is not None else FakeNavigation()
+        self.dialogs = []
+
+    def instantiateDialog(self, screen, *args, **kwargs):
+        dialog = screen(self, *args, **kwargs)
+        self.dialogs.append(dialog)
+        return dialog
+
+    def execDialog(self, dialog):
+        dialog.execing = True
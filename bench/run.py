@@ -0,0 +1,1072 @@
+"""
+..
+   This file is part of the CoCy program.
+   Copyright (C) 2018 Michael N. Lipp
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+.. codeauthor:: mnl
+
+Runs scripted control point workloads against the renderer on a
+plain Linux machine. Enigma2 is replaced by the stand-ins in
+``bench/fakes``, everything else (twisted, circuits, cocy) must be
+installed. The twisted reactor runs on the main thread (like
+Enigma2's main loop), the circuits components in their own thread.
+
+Usage::
+
+    python bench/run.py [--quick] [scenario ...]
+
+Available scenarios are listed by ``--help``. A scenario fails if
+one of its checks doesn't hold, the exit code is 1 if any failed.
+"""
+import hashlib
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "fakes"))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from twisted.internet import defer, reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from circuits import Component
+from circuits.core.events import Event
+import enigma
+from navigation import FakeSession, FakeNavigation
+from CoCy.renderer import Enigma2Player
+from CoCy.metrics import metrics, Histogram, tree_gauges
+from CoCy.httpfetch import HTTPFetcher
+from CoCy.logbuffer import LOGGER_NAME
+from CoCy.resume import ResumeStore
+from CoCy.watchdog import MainLoopWatchdog
+from CoCy.ebrigde import mainThreadBridge, MainThreadBridge, BridgeTimeout
+
+DIDL = '<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">' \
+    '<item id="%d" parentID="0" restricted="1">' \
+    '<res protocolInfo="http-get:*:%s:*">%s</res></item></DIDL-Lite>'
+
+class Bench(object):
+    """
+    A renderer with a fake session, registered with a circuits
+    component tree that runs in its own thread.
+    """
+
+    def __init__(self, nav=None, **kwargs):
+        self.session = FakeSession(nav)
+        self.root = Component()
+        self.player = Enigma2Player(self.session, **kwargs)
+        self.player.register(self.root)
+        # Manager.start() doesn't allow the thread to be joined
+        self._thread = threading.Thread(target=self.root.run,
+                                        name="circuits")
+        self._thread.daemon = True
+        self._thread.start()
+        self.wait_for(lambda: self.nav._trackers)
+
+    def stop(self):
+        # Let the main thread work requested so far complete
+        self.wait_for(lambda: self.player._transaction is None)
+        self.root.stop()
+        self._thread.join(5)
+        assert not self._thread.is_alive(), "circuits thread still running"
+
+    @property
+    def nav(self):
+        return self.session.nav
+
+    def fire(self, name, *args):
+        self.root.fire(Event.create(name, *args), self.player.channel)
+
+    def load(self, uri, mimetype, index=0):
+        self.fire("load", uri, DIDL % (index, mimetype, uri))
+
+    def wait_for(self, condition, timeout=10.0):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                raise AssertionError("Timeout waiting for condition")
+            time.sleep(0.002)
+
+    def play_and_wait(self, uri, mimetype="audio/mpeg", index=0):
+        played = len(self.nav.played)
+        self.load(uri, mimetype, index)
+        # Like a control point, wait for SetAVTransportURI to complete
+        self.wait_for(lambda: self.player._service_uri == uri)
+        self.fire("play")
+        self.wait_for(lambda: len(self.nav.played) > played
+                      and self.player.state == "PLAYING")
+
+
+class FakeReactor(object):
+    """
+    Collects the calls submitted to the main thread, they are only
+    executed when :meth:`pump` is invoked.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, func, *args, **kwargs):
+        self.calls.append((func, args, kwargs))
+
+    def callLater(self, delay, func, *args, **kwargs):
+        self.calls.append((func, args, kwargs))
+
+    def pump(self):
+        calls, self.calls = self.calls, []
+        for func, args, kwargs in calls:
+            func(*args, **kwargs)
+        return len(calls)
+
+
+def scenario_bridge(quick):
+    """The main thread bridge driven by a fake reactor."""
+    fake = FakeReactor()
+    on_main = threading.local()
+    bridge = MainThreadBridge(reactor=fake, timeout=0.2,
+        is_main_thread=lambda: getattr(on_main, "value", False),
+        metrics=metrics)
+    # Results are delivered when the "main thread" runs the call
+    future = bridge.submit(lambda x: x * 2, 21)
+    assert not future.done()
+    assert fake.pump() == 1
+    assert future.result(0) == 42
+    # Exceptions are raised in the waiting thread
+    future = bridge.submit(lambda: 1 / 0)
+    fake.pump()
+    try:
+        future.result(0)
+        raise AssertionError("Exception not passed on")
+    except ZeroDivisionError:
+        pass
+    # A batch is a single hop, failures don't affect the other calls
+    futures = bridge.submitBatch([lambda: 1, (lambda: 1 / 0,),
+                                  (lambda x: x, (3,))])
+    assert fake.pump() == 1
+    assert [f.result(0) for f in futures[::2]] == [1, 3]
+    # A main thread that doesn't respond makes a blocking call fail
+    started = time.time()
+    try:
+        bridge.blockingCall(lambda: None)
+        raise AssertionError("No timeout")
+    except BridgeTimeout:
+        pass
+    waited = time.time() - started
+    assert 0.2 <= waited < 1.0, waited
+    fake.pump()
+    # Blocking calls are answered by a pumping main thread
+    def pump():
+        on_main.value = True
+        end = time.time() + 0.5
+        while time.time() < end:
+            fake.pump()
+            time.sleep(0.005)
+    pumper = threading.Thread(target=pump)
+    pumper.start()
+    answers = [bridge.blockingCall(lambda i=i: i) for i in range(20)]
+    pumper.join()
+    assert answers == range(20)
+    # A deferred that never fires doesn't block forever, although
+    # the main loop is healthy
+    class HealthyLoop(object):
+        interval = 0.05
+        running = True
+        shutting_down = False
+        def stalled(self):
+            return 0.0
+        def timeout(self):
+            return 0.3
+    bridge.watchdog = HealthyLoop()
+    pumper = threading.Thread(target=pump)
+    pumper.start()
+    started = time.time()
+    try:
+        bridge.blockingCall(defer.Deferred)
+        raise AssertionError("No timeout")
+    except BridgeTimeout:
+        pass
+    never_fired = time.time() - started
+    pumper.join()
+    bridge.watchdog = None
+    assert 0.3 <= never_fired < 0.5, never_fired
+    # On the main thread, calls are made directly
+    on_main.value = True
+    assert bridge.blockingCall(lambda: "direct") == "direct"
+    return { "checks": "passed",
+             "waited for timeout (s)": waited,
+             "waited for deferred (s)": never_fired }
+
+def scenario_storm(quick):
+    """Load/play/stop cycles as fast as the control point can send them."""
+    bench = Bench()
+    cycles = 10 if quick else 50
+    latency = Histogram()
+    started = time.time()
+    for i in range(cycles):
+        begin = time.time()
+        bench.play_and_wait("http://127.0.0.1/track%d.mp3" % i, index=i)
+        latency.observe(time.time() - begin)
+        bench.fire("stop")
+        bench.wait_for(lambda: bench.player.state == "IDLE")
+    elapsed = time.time() - started
+    bench.stop()
+    assert latency.percentile(90) < 0.5, latency.snapshot()
+    return { "cycles": cycles, "cycles/s": cycles / elapsed,
+             "load+play to PLAYING": latency.snapshot() }
+
+def scenario_pause(quick):
+    """Pause and play sent while the main loop is blocked."""
+    bench = Bench()
+    bench.play_and_wait("http://127.0.0.1/movie.mp4", "video/mp4")
+    time.sleep(0.5)
+    before = bench.nav.getCurrentService().position()
+    started = enigma.STATS.get("playService", 0)
+    # Both requests arrive before the main loop gets to them
+    reactor.callFromThread(time.sleep, 0.3)
+    time.sleep(0.05)
+    bench.fire("pause")
+    bench.wait_for(lambda: bench.player.state == "PAUSED")
+    bench.fire("play")
+    bench.wait_for(lambda: bench.player._transaction is None
+                   and bench.player.state == "PLAYING")
+    time.sleep(0.1)
+    after = bench.nav.getCurrentService().position()
+    restarts = enigma.STATS.get("playService", 0) - started
+    bench.stop()
+    assert restarts == 0, "%d restarts" % restarts
+    assert after > before, (before, after)
+    return { "position before": before,
+             "position after": after,
+             "restarts": restarts }
+
+def scenario_live(quick):
+    """A live stream (no duration) that keeps updating its info."""
+    bench = Bench(nav=FakeNavigation(duration=None))
+    bench.play_and_wait("http://127.0.0.1/live.ts", "video/mp2t")
+    before = enigma.STATS.get("isCurrentlySeekable", 0)
+    updates = 40 if quick else 200
+    for i in range(updates):
+        reactor.callFromThread(bench.nav.emit,
+                               enigma.iPlayableService.evUpdatedInfo)
+        time.sleep(0.025)
+    lookups = enigma.STATS.get("isCurrentlySeekable", 0) - before
+    bench.stop()
+    # The failed lookup isn't retried before its backoff has expired
+    assert lookups < updates / 4, "%d duration lookups" % lookups
+    return { "info updates": updates,
+             "duration lookups": lookups }
+
+def scenario_polling(quick):
+    """GetPositionInfo at 2 Hz from several clients while playing."""
+    bench = Bench(position_resync=1.0)
+    bench.play_and_wait("http://127.0.0.1/movie.mp4", "video/mp4")
+    clients = 4
+    duration = 3.0 if quick else 15.0
+    latency = Histogram()
+    reads = enigma.STATS.get("getPlayPosition", 0)
+    errors = []
+    def client():
+        end = time.time() + duration
+        while time.time() < end:
+            begin = time.time()
+            position = bench.player.current_position()
+            latency.observe(time.time() - begin)
+            if position is None:
+                errors.append(position)
+            time.sleep(0.5)
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    position = bench.player.current_position()
+    actual = bench.nav.getCurrentService().position()
+    gauges = metrics.snapshot()["gauges"]
+    bench.stop()
+    assert not errors, "%d unknown positions" % len(errors)
+    assert gauges["position.resyncs"] >= 2, "no drift measured"
+    assert gauges["position.extrapolations"] > gauges["position.resyncs"]
+    assert gauges["position.max_drift"] < 0.1, gauges["position.max_drift"]
+    assert abs(position - actual) < 0.1
+    return { "polls": latency.count, "polls/s": latency.count / duration,
+             "player reads": enigma.STATS.get("getPlayPosition", 0) - reads,
+             "resyncs": gauges["position.resyncs"],
+             "extrapolations": gauges["position.extrapolations"],
+             "max drift": gauges["position.max_drift"],
+             "drift": abs(position - actual),
+             "poll latency": latency.snapshot() }
+
+def scenario_scrub(quick):
+    """A seek bar being dragged: a burst of seeks 25 ms apart."""
+    bench = Bench(position_resync=0.5)
+    bench.play_and_wait("http://127.0.0.1/movie.mp4", "video/mp4")
+    bench.player.current_position()
+    seeks = 20 if quick else 80
+    before = enigma.STATS.get("seekTo", 0)
+    started = time.time()
+    for i in range(seeks):
+        bench.fire("seek", 10 + i * 1.5)
+        time.sleep(0.025)
+    target = 10 + (seeks - 1) * 1.5
+    bench.wait_for(lambda: abs(bench.nav.getCurrentService().position()
+                               - target) < 1.0)
+    elapsed = time.time() - started
+    # A seek starts over from its target, it isn't drift
+    time.sleep(0.6)
+    position = bench.player.current_position()
+    actual = bench.nav.getCurrentService().position()
+    gauges = metrics.snapshot()["gauges"]
+    bench.stop()
+    demuxer_seeks = enigma.STATS.get("seekTo", 0) - before
+    assert demuxer_seeks <= 3, "%d demuxer seeks" % demuxer_seeks
+    assert elapsed < seeks * 0.025 + 1.0, elapsed
+    assert gauges["position.max_drift"] < 0.1, gauges["position.max_drift"]
+    assert abs(position - actual) < 0.1
+    return { "seek requests": seeks,
+             "demuxer seeks": demuxer_seeks,
+             "until at target (s)": elapsed,
+             "max drift": gauges["position.max_drift"],
+             "seek handler": metrics.histogram("handler.seek").snapshot(),
+             "request to seek": metrics.histogram("seek.delay").snapshot() }
+
+class PictureSite(Site):
+    """
+    Serves the files from *directory*, each response is delayed by
+    *delay* seconds. If *pause* is set, the second half of a file is
+    sent *pause* seconds after the first. Counts connections and
+    requests.
+    """
+
+    def __init__(self, directory, delay=0, pause=0):
+        Site.__init__(self, _Pictures(directory, delay, pause))
+        self.connections = 0
+        self.requests = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return Site.buildProtocol(self, addr)
+
+    def getResourceFor(self, request):
+        self.requests += 1
+        return Site.getResourceFor(self, request)
+
+class _Pictures(Resource):
+    isLeaf = True
+
+    def __init__(self, directory, delay, pause):
+        Resource.__init__(self)
+        self._directory = directory
+        self._delay = delay
+        self._pause = pause
+
+    def render_GET(self, request):
+        path = os.path.join(self._directory, request.postpath[-1])
+        def _send():
+            if not os.path.exists(path):
+                request.setResponseCode(404)
+                request.finish()
+                return
+            with open(path, "rb") as f:
+                data = f.read()
+            request.setHeader("Content-Type", "image/jpeg")
+            request.setHeader("Content-Length", str(len(data)))
+            if not self._pause:
+                request.write(data)
+                request.finish()
+                return
+            request.write(data[:len(data) / 2])
+            calls.append(reactor.callLater(self._pause, _rest, data))
+        def _rest(data):
+            request.write(data[len(data) / 2:])
+            request.finish()
+        calls = [reactor.callLater(self._delay, _send)]
+        request.notifyFinish().addErrback(
+            lambda _: calls[-1].active() and calls[-1].cancel())
+        return NOT_DONE_YET
+
+def serve_pictures(bench, prefix, count, delay=0, pause=0):
+    """
+    Creates *count* pictures and serves them over HTTP. Returns
+    the base URL and the listening port (whose factory is a
+    :class:`PictureSite`).
+    """
+    directory = os.path.join("/tmp", "cocy-bench-pictures")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for i in range(count):
+        with open(os.path.join(directory, "%s%d.jpg" % (prefix, i)),
+                  "wb") as f:
+            f.write(os.urandom(256 * 1024))
+    port = []
+    def _listen():
+        port.append(reactor.listenTCP(0, PictureSite(directory, delay, pause),
+                                      interface="127.0.0.1"))
+    reactor.callFromThread(_listen)
+    bench.wait_for(lambda: port)
+    return ("http://127.0.0.1:%d/%s" % (port[0].getHost().port, prefix),
+            port[0])
+
+def scenario_slideshow(quick):
+    """Pictures shown one after another, then the album again."""
+    pictures = 5 if quick else 20
+    bench = Bench()
+    base, port = serve_pictures(bench, "p", pictures)
+    latency = Histogram()
+    for rnd in range(2):
+        for i in range(pictures):
+            begin = time.time()
+            bench.load(base + "%d.jpg" % i, "image/jpeg", i)
+            bench.fire("play")
+            bench.wait_for(lambda: bench.player.state == "TRANSITIONING")
+            bench.wait_for(lambda: bench.player.state == "PLAYING")
+            latency.observe(time.time() - begin)
+    bench.stop()
+    reactor.callFromThread(port.stopListening)
+    assert port.factory.connections == 1, port.factory.connections
+    # The second round is served from the cache
+    assert port.factory.requests == pictures, port.factory.requests
+    return { "pictures shown": latency.count,
+             "connections": port.factory.connections,
+             "decodes": enigma.STATS.get("startDecode", 0),
+             "time to display": latency.snapshot() }
+
+def scenario_slideshow_next(quick):
+    """A slideshow with the next picture always announced in advance."""
+    pictures = 5 if quick else 20
+    bench = Bench()
+    base, port = serve_pictures(bench, "n", pictures)
+    latency = Histogram()
+    displayed = metrics.histogram("picture.time_to_display")
+    for i in range(pictures):
+        begin = time.time()
+        bench.load(base + "%d.jpg" % i, "image/jpeg", i)
+        bench.fire("play")
+        # Preloaded pictures are PLAYING too fast for polling the state
+        bench.wait_for(lambda: displayed.count > i)
+        latency.observe(time.time() - begin)
+        uri = base + "%d.jpg" % (i + 1)
+        bench.fire("prepare_next", uri, DIDL % (i + 1, "image/jpeg", uri))
+        # Viewing time
+        time.sleep(0.3)
+    bench.stop()
+    reactor.callFromThread(port.stopListening)
+    preloaded = metrics.snapshot()["counters"].get("picture.decoded_hits", 0)
+    assert preloaded >= pictures - 1, "%d shown preloaded" % preloaded
+    return { "pictures shown": latency.count,
+             "decodes": enigma.STATS.get("startDecode", 0),
+             "shown preloaded": preloaded,
+             "time to display": latency.snapshot() }
+
+def scenario_album(quick):
+    """An album browsed quickly, only the last picture is looked at."""
+    pictures = 10 if quick else 40
+    bench = Bench()
+    base, port = serve_pictures(bench, "a", pictures, delay=0.1)
+    begin = time.time()
+    for i in range(pictures):
+        bench.load(base + "%d.jpg" % i, "image/jpeg", i)
+        bench.fire("play")
+        time.sleep(0.03)
+    displayed = metrics.histogram("picture.time_to_display")
+    bench.wait_for(lambda: displayed.count > 0
+                   and bench.player.state == "PLAYING")
+    elapsed = time.time() - begin
+    bench.stop()
+    reactor.callFromThread(port.stopListening)
+    counters = metrics.snapshot()["counters"]
+    assert enigma.STATS.get("startDecode", 0) <= 2, "skipped pictures decoded"
+    # Skipped pictures that were still queued aren't requested
+    assert counters.get("http.fetch_cancelled", 0) > 0
+    assert port.factory.requests < pictures, port.factory.requests
+    # Skipped pictures that were already requested complete into
+    # the cache, their connections are reused
+    assert port.factory.connections < port.factory.requests, \
+        (port.factory.connections, port.factory.requests)
+    return { "pictures requested": pictures,
+             "connections": port.factory.connections,
+             "http requests": port.factory.requests,
+             "fetches cancelled": counters.get("http.fetch_cancelled", 0),
+             "decodes": enigma.STATS.get("startDecode", 0),
+             "until last shown (s)": elapsed }
+
+def scenario_fetch(quick):
+    """Picture downloads cancelled while the body is being received."""
+    pictures = 5 if quick else 20
+    bench = Bench()
+    base, port = serve_pictures(bench, "c", pictures + 1, pause=0.2)
+    fetcher = HTTPFetcher()
+    directory = tempfile.mkdtemp()
+    results = []
+    def fetch(i, cancel_after=None):
+        d = fetcher.download(base + "%d.jpg" % i,
+                             os.path.join(directory, "%d.jpg" % i))
+        d.addBoth(results.append)
+        if cancel_after is not None:
+            # First half received, second half pending
+            reactor.callLater(cancel_after, d.cancel)
+    for i in range(pictures):
+        on_main_thread(fetch, i, 0.1)
+        bench.wait_for(lambda: len(results) == i + 1)
+        # Let the rest of the body arrive (and be drained)
+        time.sleep(0.25)
+    on_main_thread(fetch, pictures)
+    bench.wait_for(lambda: len(results) == pictures + 1)
+    connections = port.factory.connections
+    # Queued downloads take longer than the timeout in total,
+    # but the timeout applies to each download only
+    queued = []
+    def fetch_queued():
+        fetcher = HTTPFetcher(max_concurrent=1, timeout=0.5)
+        for i in range(3):
+            fetcher.download(base + "%d.jpg" % i,
+                             os.path.join(directory, "q%d.jpg" % i)) \
+                .addBoth(queued.append)
+    on_main_thread(fetch_queued)
+    bench.wait_for(lambda: len(queued) == 3)
+    bench.stop()
+    on_main_thread(fetcher.close)
+    reactor.callFromThread(port.stopListening)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    counters = metrics.snapshot()["counters"]
+    cancelled = counters.get("http.fetch_cancelled", 0)
+    assert cancelled == pictures, "%d cancelled" % cancelled
+    assert isinstance(results[-1], str), results[-1]
+    assert all(isinstance(result, str) for result in queued), queued
+    assert connections == 1, connections
+    return { "downloads": pictures + 1,
+             "cancelled": cancelled,
+             "drained": counters.get("http.fetch_drained", 0),
+             "connections": connections }
+
+def scenario_flip(quick):
+    """Pictures flipped faster than they are decoded, then back again."""
+    pictures = 10 if quick else 40
+    bench = Bench()
+    base, port = serve_pictures(bench, "f", pictures)
+    def shown():
+        pixmap = bench.player._picDlg["pic"].instance.pixmap
+        return pixmap and pixmap[1]
+    def flip_to(i):
+        url = base + "%d.jpg" % i
+        bench.load(url, "image/jpeg", i)
+        bench.fire("play")
+        return hashlib.md5(url).hexdigest()
+    for i in range(pictures):
+        last = flip_to(i)
+        time.sleep(0.03)
+    bench.wait_for(lambda: last in (shown() or ""))
+    # Back to the previous one (decoded, if still cached) and forth
+    flip_to(pictures - 2)
+    last = flip_to(pictures - 1)
+    time.sleep(0.3)
+    final = shown()
+    bench.stop()
+    reactor.callFromThread(port.stopListening)
+    assert last in final, "%s shown instead of the last picture" % final
+    assert not enigma.STATS.get("decodeRefused"), "decoder was busy"
+    return { "pictures flipped": pictures + 2,
+             "decodes": enigma.STATS.get("startDecode", 0),
+             "decoded hits": metrics.snapshot()["counters"]
+                .get("picture.decoded_hits", 0) }
+
+class ThrottledOrigin(Resource):
+    """
+    Serves *size* bytes at *rate* bytes/s, supports ranges. Sending
+    pauses for *stall* seconds after *stall_at* bytes (a network or
+    media server hiccup). Like a real server, it doesn't send more
+    than the connection accepts. Counts requests.
+    """
+    isLeaf = True
+
+    def __init__(self, size, rate, stall_at=None, stall=0):
+        Resource.__init__(self)
+        self.requests = 0
+        self.size = size
+        self.rate = rate
+        self.stall_at = stall_at
+        self.stall = stall
+        self.data = os.urandom(size)
+
+    def render_GET(self, request):
+        self.requests += 1
+        start = 0
+        spec = request.getHeader("range")
+        if spec:
+            start = int(spec.split("=")[1].split("-")[0])
+            request.setResponseCode(206)
+            request.setHeader("Content-Range", "bytes %d-%d/%d"
+                              % (start, self.size - 1, self.size))
+        request.setHeader("Content-Type", "video/mp4")
+        request.setHeader("Content-Length", str(self.size - start))
+        chunk = 16 * 1024
+        request.channel.transport.getHandle().setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, 32 * 1024)
+        state = { "offset": start, "call": None, "stalled": False,
+                  "paused": False }
+        class _Producer(object):
+            def pauseProducing(self):
+                state["paused"] = True
+            def resumeProducing(self):
+                state["paused"] = False
+            def stopProducing(self):
+                _gone(None)
+        def _send():
+            state["call"] = None
+            if state["paused"]:
+                state["call"] = reactor.callLater(0.01, _send)
+                return
+            offset = state["offset"]
+            if offset >= self.size:
+                request.unregisterProducer()
+                request.finish()
+                return
+            delay = float(chunk) / self.rate
+            if self.stall_at is not None and offset >= self.stall_at \
+                    and not state["stalled"]:
+                state["stalled"] = True
+                delay = self.stall
+            request.write(self.data[offset:offset + chunk])
+            state["offset"] = offset + chunk
+            state["call"] = reactor.callLater(delay, _send)
+        def _gone(_):
+            if state["call"] is not None and state["call"].active():
+                state["call"].cancel()
+        request.notifyFinish().addErrback(_gone)
+        request.registerProducer(_Producer(), True)
+        _send()
+        return NOT_DONE_YET
+
+def consume(url, rate, size, headers=""):
+    """
+    Reads *size* bytes from *url* like a player with a small input
+    buffer that plays *rate* bytes/s. Returns the response head and
+    the total time that the player had to wait for data.
+    """
+    host, rest = url[len("http://"):].split("/", 1)
+    address, port = host.split(":")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024)
+    sock.connect((address, int(port)))
+    sock.sendall("GET /%s HTTP/1.1\r\nHost: %s\r\n%s\r\n"
+                 % (rest, host, headers))
+    data = ""
+    while "\r\n\r\n" not in data:
+        data += sock.recv(4096)
+    head, data = data.split("\r\n\r\n", 1)
+    received = len(data)
+    waited = 0.0
+    tick = 0.05
+    due = time.time()
+    while received < size:
+        # The player needs the next portion of data
+        due += tick
+        needed = min(size, received + int(rate * tick))
+        while received < needed:
+            block = sock.recv(min(needed - received, 65536))
+            if not block:
+                break
+            received += len(block)
+        now = time.time()
+        if now > due:
+            waited += now - due
+            due = now
+        else:
+            time.sleep(due - now)
+        if not block:
+            break
+    sock.close()
+    return head, waited
+
+def scenario_stream(quick):
+    """Playback from a media server that stalls, direct and proxied."""
+    from CoCy.streamproxy import StreamProxy
+    size = (2 if quick else 8) * 1024 * 1024
+    rate = 256 * 1024
+    origin = ThrottledOrigin(size, 4 * rate, stall_at=size / 3, stall=1.5)
+    port = []
+    proxy = []
+    def _listen():
+        port.append(reactor.listenTCP(0, Site(origin),
+                                      interface="127.0.0.1"))
+        proxy.append(StreamProxy(buffer_size=4 * 1024 * 1024))
+    reactor.callFromThread(_listen)
+    while not proxy:
+        time.sleep(0.01)
+    url = "http://127.0.0.1:%d/movie.mp4" % port[0].getHost().port
+    local = []
+    reactor.callFromThread(lambda: local.append(proxy[0].url_for(url)))
+    while not local:
+        time.sleep(0.01)
+    _, direct = consume(url, rate, size)
+    _, proxied = consume(local[0], rate, size)
+    stream = proxy[0].last_stream
+    head, _ = consume(local[0], rate, 64 * 1024,
+                      "Range: bytes=%d-\r\n" % (size / 2))
+    # The renderer hands the proxy URL to the player and doesn't
+    # warm the origin for the next track (the proxy requests it)
+    bench = Bench(stream_buffer=4 * 1024 * 1024, warm_next=True)
+    bench.play_and_wait(url, "video/mp4")
+    played = bench.nav.played[-1][1].getPath()
+    requests = origin.requests
+    next_url = url + "?next"
+    bench.fire("prepare_next", next_url, DIDL % (1, "video/mp4", next_url))
+    bench.wait_for(lambda: bench.player._next is not None)
+    time.sleep(0.2)
+    warmed = origin.requests - requests
+    # Pictures aren't streams, they don't use the proxy
+    picture = "http://127.0.0.1/picture.jpg"
+    slots = len(bench.player._proxy._urls)
+    bench.load(picture, "image/jpeg", 2)
+    bench.wait_for(lambda: bench.player._service_uri == picture)
+    picture_path = bench.player._service.getPath()
+    picture_slots = len(bench.player._proxy._urls) - slots
+    bench.stop()
+    def _stop():
+        port[0].stopListening()
+        proxy[0].stop()
+    reactor.callFromThread(_stop)
+    range_passed = head.split("\r\n")[0].endswith("206 Partial Content") \
+        and ("bytes %d-" % (size / 2)) in head
+    uses_proxy = played.startswith("http://127.0.0.1:") and played != url
+    assert direct > 0.5, "origin didn't stall the player"
+    assert proxied < 0.2, "proxied playback waited %.2f s" % proxied
+    assert stream.underruns == 0, stream.underruns
+    assert range_passed, head
+    assert uses_proxy, played
+    assert warmed == 0, "origin warmed through the proxy"
+    assert picture_path == picture and picture_slots == 0, picture_path
+    return { "waiting direct (s)": direct,
+             "waiting proxied (s)": proxied,
+             "proxy underruns": stream.underruns,
+             "proxy throughput": stream.throughput,
+             "range passed": range_passed,
+             "player uses proxy": uses_proxy }
+
+def scenario_gapless(quick):
+    """A queue of short tracks, the next one always set in advance."""
+    bench = Bench(nav=FakeNavigation(duration=1.0, auto_eof=True))
+    tracks = 3 if quick else 10
+    bench.play_and_wait("http://127.0.0.1/track0.mp3")
+    for i in range(1, tracks + 1):
+        uri = "http://127.0.0.1/track%d.mp3" % i
+        bench.fire("prepare_next", uri, DIDL % (i, "audio/mpeg", uri))
+        bench.wait_for(lambda: bench.player.source == uri)
+    # The last switch completes when the player has started the track
+    switches = metrics.histogram("play.track_switch")
+    bench.wait_for(lambda: switches.count == tracks)
+    bench.stop()
+    assert switches.percentile(90) < 0.5, switches.snapshot()
+    return { "tracks": tracks,
+             "track switch": switches.snapshot() }
+
+def scenario_volume(quick):
+    """A volume slider being dragged: set_volume every 10 ms."""
+    bench = Bench()
+    updates = count_updates(bench)
+    changes = 50 if quick else 200
+    for i in range(changes):
+        bench.fire("set_volume", (i % 100) / 100.0)
+        time.sleep(0.01)
+    final = ((changes - 1) % 100) / 100.0
+    volumes = lambda: [changed["volume"] for changed in updates
+                       if "volume" in changed]
+    bench.wait_for(lambda: volumes() and volumes()[-1] == final)
+    volctrl = enigma.eDVBVolumecontrol.getInstance()
+    bench.wait_for(lambda: volctrl.getVolume() == int(round(final * 100)))
+    bench.stop()
+    hardware_changes = enigma.STATS.get("setVolume", 0)
+    assert hardware_changes < changes / 4
+    # A ramp starts from the hardware level, 0.5 to 1 in 0.1 steps
+    volctrl.setVolume(50, 50)
+    levels = []
+    set_volume = volctrl.setVolume
+    def record(left, right):
+        levels.append(left)
+        set_volume(left, right)
+    volctrl.setVolume = record
+    bench = Bench(volume_ramp=1.0)
+    try:
+        bench.fire("set_volume", 1.0)
+        bench.wait_for(lambda: levels and levels[-1] == 100)
+        bench.stop()
+    finally:
+        del volctrl.setVolume
+    assert levels == [60, 70, 80, 90, 100], levels
+    return { "volume requests": changes,
+             "hardware changes": hardware_changes,
+             "ramp steps": len(levels),
+             "provider updates": len(volumes()),
+             "set_volume handler": metrics.histogram("handler.set_volume")
+                .snapshot() }
+
+def count_updates(bench):
+    """
+    Registers a listener like a control point's event subscription,
+    returns the list of received changes.
+    """
+    updates = []
+    class Listener(Component):
+        channel = bench.player.channel
+        def provider_updated(self, provider, changed):
+            updates.append(changed)
+    Listener().register(bench.root)
+    return updates
+
+def scenario_events(quick):
+    """Track changes as seen by a control point, a repeated track last."""
+    bench = Bench(nav=FakeNavigation(duration=1.0, auto_eof=True))
+    updates = count_updates(bench)
+    tracks = 5 if quick else 20
+    latency = Histogram()
+    for i in range(tracks):
+        published = len(updates)
+        uri = "http://127.0.0.1/track%d.mp3" % i
+        bench.play_and_wait(uri, index=i)
+        # From the player playing to control points being notified
+        begin = time.time()
+        bench.wait_for(lambda: "PLAYING" in [
+            changed.get("state") for changed in updates[published:]])
+        latency.observe(time.time() - begin)
+    # The same track as next, its source must be announced again
+    published = len(updates)
+    bench.fire("prepare_next", uri, DIDL % (tracks - 1, "audio/mpeg", uri))
+    bench.wait_for(lambda: uri in [changed.get("source")
+                                   for changed in updates[published:]
+                                   if "next_source" not in changed])
+    time.sleep(0.3)
+    bench.stop()
+    states = [changed["state"] for changed in updates
+              if "state" in changed]
+    assert states and states[-1] == "PLAYING", states
+    assert latency.snapshot()["max"] < 0.05, latency.snapshot()
+    return { "updates": len(updates),
+             "TRANSITIONING": states.count("TRANSITIONING"),
+             "final state": states[-1],
+             "PLAYING latency": latency.snapshot() }
+
+def on_main_thread(func, *args):
+    """
+    Invokes *func* on the main thread and waits for it to return.
+    """
+    done = threading.Event()
+    def _call():
+        func(*args)
+        done.set()
+    reactor.callFromThread(_call)
+    done.wait()
+
+def scenario_busy(quick):
+    """Position polls while the main loop is repeatedly blocked."""
+    watchdog = MainLoopWatchdog(interval=0.1)
+    on_main_thread(watchdog.start)
+    mainThreadBridge().watchdog = watchdog
+    bench = Bench(watchdog=watchdog)
+    bench.play_and_wait("http://127.0.0.1/movie.mp4", "video/mp4")
+    bench.player._position.resync_interval = 0.5
+    latency = Histogram()
+    stalls = 3 if quick else 10
+    for i in range(stalls):
+        # Like an EPG load, the main loop doesn't respond for 0.8 s
+        reactor.callFromThread(time.sleep, 0.8)
+        end = time.time() + 1.5
+        while time.time() < end:
+            begin = time.time()
+            bench.player.current_position()
+            latency.observe(time.time() - begin)
+            time.sleep(0.1)
+    # Messages of a disabled level don't consult the watchdog
+    consulted = []
+    busy = watchdog.busy
+    watchdog.busy = lambda: consulted.append(True) or busy()
+    logger = logging.getLogger(LOGGER_NAME)
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        bench.player._log(logging.DEBUG, "Disabled %s", "message")
+    finally:
+        logger.setLevel(level)
+        del watchdog.busy
+    bench.stop()
+    mainThreadBridge().watchdog = None
+    on_main_thread(watchdog.stop)
+    counters = metrics.snapshot()["counters"]
+    assert not counters.get("bridge.timeouts"), "bridge calls timed out"
+    assert counters.get("shed.position"), "no position refresh skipped"
+    assert not consulted, "watchdog consulted for a disabled message"
+    return { "stalls": stalls,
+             "poll latency": latency.snapshot(),
+             "main loop lag": metrics.histogram("mainloop.lag").snapshot(),
+             "positions extrapolated": counters.get("shed.position", 0),
+             "bridge timeouts": counters.get("bridge.timeouts", 0) }
+
+def scenario_lifecycle(quick):
+    """Play/stop/stop cycles, the component tree must not grow."""
+    bench = Bench()
+    tree_gauges(bench.root)
+    cycles = 10 if quick else 100
+    def counts():
+        gauges = metrics.snapshot()["gauges"]
+        return [gauges["tree." + name]
+                for name in ("components", "handlers", "timers")]
+    bench.play_and_wait("http://127.0.0.1/track.mp3")
+    before = counts()
+    for i in range(cycles):
+        bench.play_and_wait("http://127.0.0.1/track%d.mp3" % i, index=i)
+        bench.fire("stop")
+        bench.wait_for(lambda: bench.player.state == "IDLE")
+        bench.fire("stop")
+    time.sleep(0.3)
+    after = counts()
+    pending = metrics.snapshot()["gauges"]["renderer.delayed_actions"]
+    bench.stop()
+    assert before == after, "tree grew from %s to %s" % (before, after)
+    assert pending <= 1, "%d pending delayed actions" % pending
+    return { "cycles": cycles,
+             "components (before/after)": "%d/%d" % (before[0], after[0]),
+             "handlers (before/after)": "%d/%d" % (before[1], after[1]),
+             "timers (before/after)": "%d/%d" % (before[2], after[2]),
+             "pending delayed actions": pending }
+
+def scenario_resume(quick):
+    """A movie stopped and played again, continues where it was left."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "resume.db")
+    store = ResumeStore(path)
+    on_main_thread(store.start)
+    bench = Bench(resume=store)
+    # Watching TV when the control point takes over
+    tv = enigma.eServiceReference(1, 0, "tv")
+    on_main_thread(bench.nav.playService, tv)
+    uri = "http://127.0.0.1/movie.mp4"
+    bench.play_and_wait(uri, "video/mp4")
+    bench.fire("seek", 100)
+    bench.wait_for(lambda: bench.nav.getCurrentService().position() >= 100)
+    bench.fire("stop")
+    bench.wait_for(lambda: bench.player.state == "IDLE")
+    begin = time.time()
+    bench.play_and_wait(uri, "video/mp4")
+    bench.wait_for(lambda: metrics.snapshot()["counters"].get("resume.restored"))
+    elapsed = time.time() - begin
+    position = bench.nav.getCurrentService().position()
+    # The TV service restored after stopping doesn't resume the movie
+    bench.fire("stop")
+    bench.wait_for(lambda: bench.nav.played[-1][1] is tv, timeout=7.0)
+    time.sleep(0.5)
+    tv_seeked_to = bench.nav.getCurrentService().seeked_to
+    # Playing the movie again (same source) still resumes it
+    bench.fire("play")
+    bench.wait_for(lambda: bench.nav.played[-1][1].getPath() == uri)
+    bench.wait_for(lambda: metrics.snapshot()["counters"]
+                   .get("resume.restored") == 2)
+    bench.stop()
+    # The database is written by the store's thread, a slow write
+    # doesn't block the main loop
+    write = store._write
+    def slow_write(pending):
+        time.sleep(0.5)
+        write(pending)
+    store._write = slow_write
+    closed = []
+    begin = time.time()
+    on_main_thread(lambda: store.close().addBoth(closed.append))
+    on_main_thread(lambda: None)
+    blocked = time.time() - begin
+    bench.wait_for(lambda: closed)
+    # Read back after a restart
+    store = ResumeStore(path)
+    found = []
+    on_main_thread(store.start)
+    on_main_thread(lambda: store.lookup(uri).addBoth(found.append))
+    bench.wait_for(lambda: found)
+    on_main_thread(lambda: store.close().addBoth(closed.append))
+    bench.wait_for(lambda: len(closed) == 2)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    assert 100 <= position < 105, position
+    assert tv_seeked_to == 0, "TV service seeked to %s" % tv_seeked_to
+    assert blocked < 0.2, "main loop blocked for %.2f s" % blocked
+    assert found[0] is not None and 100 <= found[0] < 105, found
+    return { "resumed at": position,
+             "play to resumed (s)": elapsed,
+             "restored from database": found[0],
+             "main loop blocked (s)": blocked,
+             "database writes": metrics.snapshot()["counters"].get("resume.flushes", 0) }
+
+SCENARIOS = [("bridge", scenario_bridge), ("storm", scenario_storm),
+             ("pause", scenario_pause),
+             ("live", scenario_live),
+             ("polling", scenario_polling), ("scrub", scenario_scrub),
+             ("slideshow", scenario_slideshow),
+             ("slideshow_next", scenario_slideshow_next),
+             ("album", scenario_album), ("fetch", scenario_fetch),
+             ("flip", scenario_flip),
+             ("stream", scenario_stream),
+             ("gapless", scenario_gapless), ("volume", scenario_volume),
+             ("events", scenario_events), ("resume", scenario_resume),
+             ("busy", scenario_busy), ("lifecycle", scenario_lifecycle)]
+
+def report(name, results):
+    print "== %s" % name
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            value = ", ".join("%s=%s" % (k, _fmt(value[k]))
+                              for k in ("count", "p50", "p90", "p99", "max"))
+        else:
+            value = _fmt(value)
+        print "   %-26s %s" % (key, value)
+
+def _fmt(value):
+    if isinstance(value, float):
+        return "%.4f" % value
+    return str(value)
+
+def main(args):
+    quick = "--quick" in args
+    names = [arg for arg in args if not arg.startswith("--")]
+    if "--help" in args or [n for n in names if n not in dict(SCENARIOS)]:
+        print __doc__
+        for name, func in SCENARIOS:
+            print "  %-10s %s" % (name, func.__doc__)
+        return
+    failed = []
+    def run():
+        try:
+            for name, func in SCENARIOS:
+                if names and name not in names:
+                    continue
+                metrics.reset()
+                enigma.STATS.clear()
+                try:
+                    report(name, func(quick))
+                except Exception as e:
+                    failed.append(name)
+                    print "== %s failed: %s" % (name, e)
+        finally:
+            reactor.callFromThread(reactor.stop)
+    reactor.callWhenRunning(threading.Thread(target=run).start)
+    reactor.run()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])